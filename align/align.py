@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 import logging
 import argparse
 import deepspeech
@@ -8,11 +9,13 @@ import os.path as path
 import numpy as np
 import textdistance
 import multiprocessing
-from collections import Counter
-from search import FuzzySearch
+from multiprocessing.dummy import Pool as ThreadPool
+from collections import Counter, OrderedDict
+from search import FuzzySearch, SeedSearch
 from glob import glob
-from text import Alphabet, TextCleaner, levenshtein, similarity
-from utils import enweight, log_progress
+from text import Alphabet, TextCleaner, WeightedNGramSimilarity, bit_levenshtein, word_levenshtein
+from utils import log_progress, best_chain
+from metrics import BATCH_METRICS, wng
 from audio import DEFAULT_RATE, read_frames_from_file, vad_split
 from generate_lm import convert_and_filter_topk, build_lm
 from generate_package import create_bundle
@@ -43,6 +46,18 @@ def fail(message, code=1):
     exit(code)
 
 
+def get_clean_key(tc, content):
+    clean_key = hashlib.sha256()
+    labels = [alphabet.string_from_label(label) for label in range(alphabet.size())]
+    clean_key.update(json.dumps([tc.to_lower,
+                                 tc.normalize_space,
+                                 tc.dashes_to_ws,
+                                 args.text_meaningful_newlines,
+                                 labels]).encode('utf-8'))
+    clean_key.update(content.encode('utf-8', 'surrogatepass'))
+    return clean_key.hexdigest()
+
+
 def read_script(script_path):
     tc = TextCleaner(alphabet,
                      dashes_to_ws=not args.text_keep_dashes,
@@ -50,18 +65,36 @@ def read_script(script_path):
                      to_lower=not args.text_keep_casing)
     with open(script_path, 'r', encoding='utf-8') as script_file:
         content = script_file.read()
-        if script_path.endswith('.script'):
-            for phrase in json.loads(content):
-                tc.add_original_text(phrase['text'], meta=phrase)
-        elif args.text_meaningful_newlines:
-            for phrase in content.split('\n'):
-                tc.add_original_text(phrase)
-        else:
-            tc.add_original_text(content)
+    phrases = json.loads(content) if script_path.endswith('.script') else None
+    clean_path = None if args.text_no_clean_cache else script_path + '.clean.idx'
+    clean_key = get_clean_key(tc, content)
+    if clean_path and tc.load(clean_path, clean_key, metas=phrases):
+        logging.debug('Loaded cleaned text of script {} from {}'.format(script_path, clean_path))
+        return tc
+    if phrases is not None:
+        tc.add_original_texts([phrase['text'] for phrase in phrases], metas=phrases)
+    elif args.text_meaningful_newlines:
+        tc.add_original_texts(content.split('\n'))
+    else:
+        tc.add_original_text(content)
+    if clean_path:
+        try:
+            tc.save(clean_path, clean_key, metas=phrases)
+        except OSError as ex:
+            logging.warning('Unable to cache cleaned text of script {} in "{}" - continuing without: {}'
+                            .format(script_path, clean_path, ex))
     return tc
 
 
+def get_index_key(tc):
+    index_key = hashlib.sha256()
+    index_key.update(json.dumps([tc.to_lower, tc.normalize_space, tc.dashes_to_ws]).encode('utf-8'))
+    index_key.update(tc.clean_text.encode('utf-8'))
+    return index_key.hexdigest()
+
+
 model = None
+script_cache = OrderedDict()
 
 def init_stt(output_graph_path, scorer_path):
     global model
@@ -78,17 +111,60 @@ def stt(sample):
     return time_start, time_end, ' '.join(transcript.split())
 
 
+def get_search(script):
+    """
+    Returns text cleaner and search engine of a script - from a per-worker cache, if the script file
+    and the text processing options did not change since they got built.
+    Least recently used entries are evicted as soon as their clean texts exceed the cache size.
+    :param script: Path to the script
+    :return: Tuple (TextCleaner, FuzzySearch)
+    """
+    cache_key = (path.abspath(script),
+                 os.path.getmtime(script),
+                 args.text_keep_dashes,
+                 args.text_keep_ws,
+                 args.text_keep_casing,
+                 args.text_meaningful_newlines)
+    if cache_key in script_cache:
+        script_cache.move_to_end(cache_key)
+        logging.debug('Process {}: Reusing search index of script {}'.format(os.getpid(), script))
+        return script_cache[cache_key]
+    logging.debug("Loading script from %s..." % script)
+    tc = read_script(script)
+    if args.align_engine == 'seed':
+        engine, engine_args, index_suffix = SeedSearch, {'seed_size': args.align_seed_size}, '.seed.idx'
+    else:
+        engine, engine_args, index_suffix = FuzzySearch, {'anchor_size': args.align_anchor_size}, '.idx'
+    search = engine(tc.clean_text,
+                    max_candidates=args.align_max_candidates,
+                    candidate_threshold=args.align_candidate_threshold,
+                    match_score=args.align_match_score,
+                    mismatch_score=args.align_mismatch_score,
+                    gap_score=args.align_gap_score,
+                    band_width=args.align_band_width,
+                    band_threshold=args.align_band_threshold,
+                    sliding_windows=args.align_sliding_windows,
+                    coarse_to_fine=args.align_coarse_to_fine,
+                    lsh_window=args.align_lsh_window,
+                    lsh_recall=args.align_lsh_recall,
+                    batch_cells=args.align_batch_cells,
+                    index_path=None if args.align_no_index_cache else script + index_suffix,
+                    index_key=get_index_key(tc),
+                    **engine_args)
+    script_cache[cache_key] = tc, search
+    cache_size = 0
+    for key in reversed(list(script_cache.keys())):
+        cache_size += len(script_cache[key][0].clean_text)
+        if cache_size > args.align_script_cache_size and key != cache_key:
+            del script_cache[key]
+    return tc, search
+
+
 def align(triple):
     tlog, script, aligned = triple
 
-    logging.debug("Loading script from %s..." % script)
-    tc = read_script(script)
-    search = FuzzySearch(tc.clean_text,
-                         max_candidates=args.align_max_candidates,
-                         candidate_threshold=args.align_candidate_threshold,
-                         match_score=args.align_match_score,
-                         mismatch_score=args.align_mismatch_score,
-                         gap_score=args.align_gap_score)
+    tc, search = get_search(script)
+    search.stats.clear()
 
     logging.debug("Loading transcription log from %s..." % tlog)
     with open(tlog, 'r', encoding='utf-8') as transcription_log_file:
@@ -111,57 +187,171 @@ def align(triple):
         logging.info('Fragment {}: {}'.format(index, reason))
         reasons[reason] += 1
 
-    def split_match(fragments, start=0, end=-1):
-        n = len(fragments)
+    transcript_lengths = np.array([len(fragment['transcript']) for fragment in fragments], dtype=np.int64)
+
+    split_pool = None
+    if args.align_split_workers > 1:
+        # encoding all transcripts upfront, so that the search's character codes and score matrix
+        # do not change anymore while threads share it
+        for fragment in fragments:
+            search.encode(' ' + fragment['transcript'])
+        search.get_score_matrix()
+        split_pool = ThreadPool(processes=args.align_split_workers)
+
+    def find_best_many(transcripts, intervals):
+        if split_pool is None:
+            return search.find_best_many(transcripts, intervals)
+        # independent searches within big text intervals run on their own threads - the rest as one batch
+        batches, small = [], []
+        for index, (start, end) in enumerate(intervals):
+            if (len(search.text) if end < 0 else end) - start >= args.align_split_min_size:
+                batches.append([index])
+            else:
+                small.append(index)
+        if len(small) > 0:
+            batches.append(small)
+        results = [None] * len(transcripts)
+        batch_results = split_pool.map(lambda batch: search.find_best_many([transcripts[i] for i in batch],
+                                                                           [intervals[i] for i in batch]), batches)
+        for batch, matches in zip(batches, batch_results):
+            for index, match in zip(batch, matches):
+                results[index] = match
+        return results
+
+    def weight_order(first, last):
+        # fragment indices of range [first, last) ordered by weight - assigning high weights
+        # to long statements near the center of the range (quadratic positional weights like enweight)
+        n = last - first - 1
         if n < 1:
-            return
-        elif n == 1:
-            weighted_fragments = [(0, fragments[0])]
+            return np.arange(first, last)
+        c = (np.arange(n + 1) + (n * -1) / 2) / n
+        weights = (1 - c * c * 4) * transcript_lengths[first:last]
+        # fragments with highest weights first - ties in fragment order
+        return first + np.argsort(-weights, kind='stable')
+
+    def split_match(fragment_ranges):
+        # Work queue of intervals, processed level by level (breadth-first), so that the next candidate
+        # fragments of all intervals of a level can be searched in one batch.
+        # Each interval is a tuple (first fragment, end fragment, start, end, weight order, current candidate)
+        # that refers to the fragment index range [first fragment, end fragment) and the text range [start, end).
+        # With --align-reuse-matches fragments that got searched before (in an enclosing interval) reuse
+        # their last match, if it lies within the current interval.
+        matched, match_cache = [], {}
+        intervals = [(first, last, start, end, weight_order(first, last), 0)
+                     for first, last, start, end in fragment_ranges if last > first]
+        while len(intervals) > 0:
+            candidates = [int(order[candidate]) for _, _, _, _, order, candidate in intervals]
+            matches, uncached = [None] * len(intervals), []
+            for interval_index, (_, _, start, end, _, _) in enumerate(intervals):
+                cached = match_cache.get(candidates[interval_index]) if args.align_reuse_matches else None
+                if cached is not None and cached[2] > 0 and \
+                        start <= cached[0] and cached[1] <= (len(search.text) if end < 0 else end):
+                    match_stats['reused'] += 1
+                    matches[interval_index] = cached
+                else:
+                    uncached.append(interval_index)
+            searched = find_best_many([fragments[candidates[i]]['transcript'] for i in uncached],
+                                      [(intervals[i][2], intervals[i][3]) for i in uncached])
+            for interval_index, match in zip(uncached, searched):
+                match_stats['searched'] += 1
+                matches[interval_index] = match
+                if args.align_reuse_matches:
+                    match_cache[candidates[interval_index]] = match
+            next_intervals = []
+            for (first, last, start, end, order, candidate), index, match in zip(intervals, candidates, matches):
+                n = last - first
+                match_start, match_end, sws_score, match_substitutions = match
+                if sws_score > (n - 1) / (2 * n):
+                    fragment = fragments[index]
+                    fragment['match-start'] = match_start
+                    fragment['match-end'] = match_end
+                    fragment['sws'] = sws_score
+                    fragment['substitutions'] = match_substitutions
+                    matched.append(fragment)
+                    for sub_first, sub_last, sub_start, sub_end in [(first, index, start, match_start),
+                                                                    (index + 1, last, match_end, end)]:
+                        if sub_last > sub_first:
+                            next_intervals.append((sub_first,
+                                                   sub_last,
+                                                   sub_start,
+                                                   sub_end,
+                                                   weight_order(sub_first, sub_last),
+                                                   0))
+                elif candidate + 1 < n:
+                    next_intervals.append((first, last, start, end, order, candidate + 1))
+            intervals = next_intervals
+        return sorted(matched, key=lambda f: f['index'])
+
+    def chain_match(fragments):
+        # Searches all long enough fragments within the whole text at once and keeps the heaviest chain
+        # of confident matches that are in fragment order as anchors. Fragments between anchors then get
+        # matched by split_match within the text between their anchors.
+        long_fragments = [f for f in fragments if len(f['transcript']) >= args.align_chain_min_length]
+        matches = find_best_many([f['transcript'] for f in long_fragments], [(0, -1)] * len(long_fragments))
+        confident = [(f, m) for f, m in zip(long_fragments, matches) if m[2] > 0.5]
+        chain = best_chain([(m[0], m[1]) for _, m in confident], [m[2] * len(f['transcript']) for f, m in confident])
+        anchors = []
+        for fragment, (match_start, match_end, sws_score, match_substitutions) in map(confident.__getitem__, chain):
+            fragment['match-start'] = match_start
+            fragment['match-end'] = match_end
+            fragment['sws'] = sws_score
+            fragment['substitutions'] = match_substitutions
+            anchors.append(fragment)
+        logging.debug('Chained {} of {} confident fragment matches'.format(len(anchors), len(confident)))
+        # fragment ranges between anchors (and before the first and after the last one) with their text intervals
+        gaps, last_index, last_end = [], 0, 0
+        for anchor in anchors:
+            gaps.append((last_index, anchor['index'], last_end, anchor['match-start']))
+            last_index, last_end = anchor['index'] + 1, anchor['match-end']
+        gaps.append((last_index, len(fragments), last_end, -1))
+        return sorted(anchors + split_match(gaps), key=lambda f: f['index'])
+
+    match_stats = Counter()
+    try:
+        if args.align_rough_mode == 'chain':
+            matched_fragments = chain_match(fragments)
         else:
-            # so we later know the original index of each fragment
-            weighted_fragments = enumerate(fragments)
-            # assigns high values to long statements near the center of the list
-            weighted_fragments = enweight(weighted_fragments)
-            weighted_fragments = map(lambda fw: (fw[0], (1 - fw[1]) * len(fw[0][1]['transcript'])), weighted_fragments)
-            # fragments with highest weights first
-            weighted_fragments = sorted(weighted_fragments, key=lambda fw: fw[1], reverse=True)
-            # strip weights
-            weighted_fragments = list(map(lambda fw: fw[0], weighted_fragments))
-        for index, fragment in weighted_fragments:
-            match = search.find_best(fragment['transcript'], start=start, end=end)
-            match_start, match_end, sws_score, match_substitutions = match
-            if sws_score > (n - 1) / (2 * n):
-                fragment['match-start'] = match_start
-                fragment['match-end'] = match_end
-                fragment['sws'] = sws_score
-                fragment['substitutions'] = match_substitutions
-                for f in split_match(fragments[0:index], start=start, end=match_start):
-                    yield f
-                yield fragment
-                for f in split_match(fragments[index + 1:], start=match_end, end=end):
-                    yield f
-                return
-        for _, _ in weighted_fragments:
-            yield None
-
-    matched_fragments = split_match(fragments)
-    matched_fragments = list(filter(lambda f: f is not None, matched_fragments))
+            matched_fragments = split_match([(0, len(fragments), 0, -1)])
+    except BaseException:
+        if split_pool is not None:
+            split_pool.terminate()
+        raise
+    finally:
+        if split_pool is not None:
+            split_pool.close()
+            split_pool.join()
+    if args.align_reuse_matches:
+        logging.debug('Reused {} of {} fragment matches from enclosing intervals ({:.2f}%)'.format(
+            match_stats['reused'],
+            match_stats['reused'] + match_stats['searched'],
+            100 * match_stats['reused'] / max(1, match_stats['reused'] + match_stats['searched'])))
+    logging.debug('Aligned {} and pruned {} Smith-Waterman candidates'.format(search.stats['aligned'],
+                                                                             search.stats['pruned']))
+    if args.align_coarse_to_fine:
+        logging.debug('Refined {} word alignments to character alignments'.format(search.stats['refined']))
+    if args.align_anchor_size:
+        logging.debug('Found anchor candidates for {} phrases'.format(search.stats['anchored']))
+    if args.align_lsh_window:
+        logging.debug('Found LSH candidates for {} phrases'.format(search.stats['hashed']))
+    if args.align_lsh_recall:
+        logging.info('LSH search found {} of {} 3gram search matches in {}'.format(search.stats['lsh-recalled'],
+                                                                                search.stats['lsh-checked'],
+                                                                                script))
 
     similarity_algos = {}
+    wng_similarity = WeightedNGramSimilarity(direction=1,
+                                             min_ngram_size=args.align_wng_min_size,
+                                             max_ngram_size=args.align_wng_max_size,
+                                             size_factor=args.align_wng_size_factor,
+                                             position_factor=args.align_wng_position_factor,
+                                             batch_cells=args.align_batch_cells)
 
     def phrase_similarity(algo, a, b):
         if algo in similarity_algos:
             return similarity_algos[algo](a, b)
         algo_impl = lambda aa, bb: None
         if algo.lower() == 'wng':
-            algo_impl = similarity_algos[algo] = lambda aa, bb: similarity(
-                aa,
-                bb,
-                direction=1,
-                min_ngram_size=args.align_wng_min_size,
-                max_ngram_size=args.align_wng_max_size,
-                size_factor=args.align_wng_size_factor,
-                position_factor=args.align_wng_position_factor)
+            algo_impl = similarity_algos[algo] = wng_similarity
         elif algo in ALGORITHMS:
             algo_impl = similarity_algos[algo] = getattr(textdistance, algo).normalized_similarity
         else:
@@ -172,10 +362,16 @@ def align(triple):
     def get_similarities(a, b, n, gap_text, gap_meta, direction):
         if direction < 0:
             a, b, gap_text, gap_meta = a[::-1], b[::-1], gap_text[::-1], gap_meta[::-1]
+        if args.align_similarity_algo.lower() == 'wng':
+            # weighting the N-grams of all extensions of b at once
+            extension_similarities = wng_similarity.extensions(a, b, gap_text[1:n + 1]).tolist()
+        else:
+            extension_similarities = [phrase_similarity(args.align_similarity_algo, a, b + gap_text[1:i + 1])
+                                      for i in range(n)]
         similarities = list(map(
             lambda i: (args.align_word_snap_factor if gap_text[i + 1] == ' ' else 1) *
                       (args.align_phrase_snap_factor if gap_meta[i + 1] is None else 1) *
-                      (phrase_similarity(args.align_similarity_algo, a, b + gap_text[1:i + 1])),
+                      extension_similarities[i],
             range(n)))
         best = max((v, i) for i, v in enumerate(similarities))[1] if n > 0 else 0
         return best, similarities
@@ -210,7 +406,7 @@ def align(triple):
         if a_end == b_start or a_start == a_end or b_start == b_end:
             continue
         gap_text = tc.clean_text[a_end - 1:b_start + 1]
-        gap_meta = tc.meta[a_end - 1:b_start + 1]
+        gap_meta = tc.get_meta(a_end - 1, b_start + 1)
 
         if a:
             a_best_index, a_similarities = get_similarities(a['transcript'],
@@ -241,14 +437,18 @@ def align(triple):
         if b:
             b['match-start'] = b_best_start
 
-    def apply_number(number_key, index, fragment, show, get_value):
+    def apply_number(number_key, index, fragment, show, get_value, get_bounded_value=None):
+        # get_bounded_value(max_val) may return any value above max_val as soon as the value is known to exceed it
         kl = number_key.lower()
         should_output = getattr(args, 'output_' + kl)
         min_val, max_val = getattr(args, 'output_min_' + kl), getattr(args, 'output_max_' + kl)
         if kl.endswith('len') and min_val is None:
             min_val = 1
         if should_output or min_val or max_val:
-            val = get_value()
+            if get_bounded_value and max_val and not should_output and not min_val:
+                val = get_bounded_value(max_val)
+            else:
+                val = get_value()
             if not kl.endswith('len'):
                 show.insert(0, '{}: {:.2f}'.format(number_key, val))
                 if should_output:
@@ -264,6 +464,37 @@ def align(triple):
                 return True
         return False
 
+    def error_rate(distance, transcript, matched, max_rate=None):
+        # the distance is only computed up to one more than the maximum rate allows, which is enough for a rate
+        # that safely exceeds max_rate
+        max_distance = None if max_rate is None else int(max_rate * len(matched) / 100) + 1
+        return 100 * distance(transcript, matched, max_distance=max_distance) / len(matched)
+
+    def is_requested(number_key):
+        kl = number_key.lower()
+        return any(getattr(args, 'output_' + kind + kl) for kind in ['', 'min_', 'max_'])
+
+    metric_values = {}
+    if args.output_metrics_engine == 'batch':
+        # computing the similarities of all matched fragments per metric in one go
+        batch_fragments = [fragment for fragment in matched_fragments
+                           if fragment.get('match-end', 0) - fragment.get('match-start', 0) > 0]
+        pairs = [(tc.clean_text[fragment['match-start']:fragment['match-end']], fragment['transcript'])
+                 for fragment in batch_fragments]
+        for algo in filter(is_requested, ALGORITHMS):
+            if algo == 'WNG':
+                values = wng(pairs, wng_similarity)
+            elif algo in BATCH_METRICS:
+                values = BATCH_METRICS[algo](pairs)
+            else:
+                continue
+            metric_values[algo] = {fragment['index']: value for fragment, value in zip(batch_fragments, values)}
+
+    def fragment_similarity(algo, index, matched, transcript):
+        if algo in metric_values:
+            return metric_values[algo][index]
+        return phrase_similarity(algo, matched, transcript)
+
     substitutions = Counter()
     result_fragments = []
     for fragment in matched_fragments:
@@ -294,7 +525,7 @@ def align(triple):
         result_fragment['text-end'] = original_end
 
         meta_dict = {}
-        for meta in list(tc.collect_meta(match_start, match_end)) + [fragment['meta']]:
+        for meta in tc.collect_meta(match_start, match_end) + [fragment['meta']]:
             for key, value in meta.items():
                 if key == 'text':
                     continue
@@ -319,20 +550,22 @@ def align(triple):
         should_skip = False
         for algo in ALGORITHMS:
             should_skip = should_skip or apply_number(algo, index, result_fragment, sample_numbers,
-                                                      lambda: 100 * phrase_similarity(algo,
-                                                                                      fragment_matched,
-                                                                                      fragment_transcript))
+                                                      lambda: 100 * fragment_similarity(algo,
+                                                                                        index,
+                                                                                        fragment_matched,
+                                                                                        fragment_transcript))
         if should_skip:
             continue
 
         if apply_number('CER', index, result_fragment, sample_numbers,
-                        lambda: 100 * levenshtein(fragment_transcript, fragment_matched) /
-                                len(fragment_matched)):
+                        lambda: error_rate(bit_levenshtein, fragment_transcript, fragment_matched),
+                        lambda max_rate: error_rate(bit_levenshtein, fragment_transcript, fragment_matched, max_rate)):
             continue
 
+        transcript_words, matched_words = fragment_transcript.split(), fragment_matched.split()
         if apply_number('WER', index, result_fragment, sample_numbers,
-                        lambda: 100 * levenshtein(fragment_transcript.split(), fragment_matched.split()) /
-                                len(fragment_matched.split())):
+                        lambda: error_rate(word_levenshtein, transcript_words, matched_words),
+                        lambda max_rate: error_rate(word_levenshtein, transcript_words, matched_words, max_rate)):
             continue
 
         substitutions += fragment['substitutions']
@@ -361,6 +594,12 @@ def main():
     logging.basicConfig()
     logging.root.setLevel(args.loglevel if args.loglevel else 20)
 
+    if args.align_engine == 'seed':
+        if args.align_anchor_size or args.align_lsh_window:
+            fail('--align-anchor-size and --align-lsh-window are not supported by --align-engine seed')
+        if args.align_sliding_windows:
+            logging.warning('With --align-engine seed --align-sliding-windows only applies to phrases without seeds')
+
     def progress(it=None, desc='Processing', total=None):
         logging.info(desc)
         return it if args.no_progress else log_progress(it, interval=args.progress_interval, total=total)
@@ -517,9 +756,14 @@ def main():
     reasons = Counter()
 
     index = 0
+    # entries of the same script in a row and handed out to workers in chunks of consecutive entries,
+    # so that workers can reuse its search index (see get_search)
+    to_align.sort(key=lambda entry: entry[1])
     pool = multiprocessing.Pool(processes=args.align_workers)
+    # about four chunks per worker (like Pool.map) - to keep the workers busy till the end
+    chunk_size = max(1, len(to_align) // (4 * (args.align_workers or multiprocessing.cpu_count())))
     for aligned_file, file_total_fragments, file_dropped_fragments, file_reasons in \
-            progress(pool.imap_unordered(align, to_align), desc='Aligning', total=len(to_align)):
+            progress(pool.imap_unordered(align, to_align, chunksize=chunk_size), desc='Aligning', total=len(to_align)):
         if args.no_progress:
             index += 1
             logging.info('Aligned file {} of {} - wrote results to "{}"'.format(index, len(to_align), aligned_file))
@@ -608,21 +852,81 @@ def parse_args():
                             help='No normalization of whitespace. Keep it as it is.')
     text_group.add_argument('--text-keep-casing', action="store_true",
                             help='No lower-casing of characters. Keep them as they are.')
+    text_group.add_argument('--text-no-clean-cache', action="store_true",
+                            help='Deactivates caching of the cleaned text of a script in a file next to it '
+                                 '(script path with suffix .clean.idx)')
 
     align_group = parser.add_argument_group(title='Alignment algorithm options')
     align_group.add_argument('--align-workers', type=int, required=False,
                              help='Number of parallel alignment workers - defaults to number of CPUs')
+    align_group.add_argument('--align-split-workers', type=int, required=False, default=1,
+                             help='Number of threads per alignment worker that search independent text intervals '
+                                  'of one file in parallel (default: 1 - no parallel search)')
+    align_group.add_argument('--align-split-min-size', type=int, required=False, default=10000,
+                             help='Minimum text interval size (in characters) for searching an interval '
+                                  'on its own thread (default: 10000)')
+    align_group.add_argument('--align-script-cache-size', type=int, required=False, default=10000000,
+                             help='Maximum total number of clean text characters of scripts whose text cleaners and '
+                                  'search indices are kept by an alignment worker for reuse (default: 10000000)')
+    align_group.add_argument('--align-engine', type=str, choices=['fuzzy', 'seed'], default='fuzzy',
+                             help='Search engine for finding candidates - "fuzzy" counts 3gram hits of candidate '
+                                  'windows, "seed" extends and chains exact word sequence matches and is faster '
+                                  'on very long scripts - phrases without such matches fall back to 3gram search, '
+                                  'anchor and LSH search are not supported (default: fuzzy)')
+    align_group.add_argument('--align-seed-size', type=int, required=False, default=2,
+                             help='Number of consecutive words that form a seed of the "seed" engine (default: 2)')
+    align_group.add_argument('--align-no-index-cache', action="store_true",
+                             help='Deactivates caching of the search index of a script in a file next to it '
+                                  '(script path with suffix .idx)')
+    align_group.add_argument('--align-rough-mode', type=str, choices=['split', 'chain'], default='split',
+                             help='Rough alignment strategy - "split" recursively matches the best remaining fragment '
+                                  'and splits the text there, "chain" matches all long fragments at once, chains the '
+                                  'confident matches and only splits the gaps between them (default: split)')
+    align_group.add_argument('--align-chain-min-length', type=int, required=False, default=20,
+                             help='Minimum transcript length of fragments that get matched at once '
+                                  'for "chain" rough alignment (default: 20)')
+    align_group.add_argument('--align-reuse-matches', action="store_true",
+                             help='Lets fragments that were already searched in an enclosing text interval reuse '
+                                  'their earlier match, if it lies within their current interval - saves searches, '
+                                  'but can return other (worse) matches than searching the current interval')
     align_group.add_argument('--align-max-candidates', type=int, required=False, default=10,
                              help='How many global 3gram match candidates are tested at max (default: 10)')
     align_group.add_argument('--align-candidate-threshold', type=float, required=False, default=0.92,
                              help='Factor for how many 3grams the next candidate should have at least ' +
                                   'compared to its predecessor (default: 0.92)')
+    align_group.add_argument('--align-sliding-windows', action="store_true",
+                             help='Places candidate windows at the offsets with the highest 3gram density '
+                                  'instead of at fixed window boundaries and aligns them within tighter intervals')
+    align_group.add_argument('--align-anchor-size', type=int, required=False,
+                             help='Minimum length of exact matches (anchors) that get looked up in a suffix array '
+                                  'of the text to find candidates - phrases without anchors fall back to 3gram '
+                                  'search (default: no anchor search)')
+    align_group.add_argument('--align-lsh-window', type=int, required=False,
+                             help='Size of the text windows of a MinHash/LSH index that is used for finding candidates '
+                                  'of very long scripts in about constant time - phrases without LSH collisions fall '
+                                  'back to 3gram search (default: no LSH search)')
+    align_group.add_argument('--align-lsh-recall', action="store_true",
+                             help='Also runs 3gram search for all phrases found by LSH search and logs how many '
+                                  'of the 3gram matches the LSH search found')
     align_group.add_argument('--align-match-score', type=int, required=False, default=100,
                              help='Matching score for Smith-Waterman alignment (default: 100)')
     align_group.add_argument('--align-mismatch-score', type=int, required=False, default=-100,
                              help='Mismatch score for Smith-Waterman alignment (default: -100)')
     align_group.add_argument('--align-gap-score', type=int, required=False, default=-100,
                              help='Gap score for Smith-Waterman alignment (default: -100)')
+    align_group.add_argument('--align-band-width', type=int, required=False,
+                             help='Restricts Smith-Waterman alignment of a candidate to a band of that many characters '
+                                  'around the diagonal implied by its 3gram hits (default: no banding)')
+    align_group.add_argument('--align-band-threshold', type=float, required=False, default=0.5,
+                             help='Minimum score of a banded Smith-Waterman alignment - if lower, the candidate gets '
+                                  'aligned without banding (default: 0.5)')
+    align_group.add_argument('--align-batch-cells', type=int, required=False, default=4194304,
+                             help='Maximum number of scoring matrix cells of candidates that get aligned together '
+                                  'in one vectorized pass - 0 aligns candidates one by one - also limits the number '
+                                  'of N-gram weights of gap extensions that get computed at once (default: 4194304)')
+    align_group.add_argument('--align-coarse-to-fine', action="store_true",
+                             help='Aligns the words of a candidate first and then only aligns the characters '
+                                  'within a few words around the aligned words')
     align_group.add_argument('--align-shrink-fraction', type=float, required=False, default=0.1,
                              help='Length fraction of the fragment that it could get shrinked during fine alignment')
     align_group.add_argument('--align-stretch-fraction', type=float, required=False, default=0.25,
@@ -652,6 +956,11 @@ def parse_args():
     output_group = parser.add_argument_group(title='Output options')
     output_group.add_argument('--output-pretty', action="store_true",
                               help='Writes indented JSON output"')
+    output_group.add_argument('--output-metrics-engine', type=str, choices=['batch', 'textdistance'],
+                              required=False, default='batch',
+                              help='Implementation of the similarity metrics that are written or filtered by - '
+                                   '"batch" computes them for all fragments at once, "textdistance" one by one '
+                                   'through the textdistance package (default: batch)')
 
     for short in NAMED_NUMBERS.keys():
         long, atype, desc = NAMED_NUMBERS[short]
@@ -0,0 +1,162 @@
+"""
+Batch implementations of the textdistance similarity metrics that are used for filtering and annotating
+aligned fragments. All functions take a list of (a, b) string pairs and return one normalized similarity
+(see textdistance's normalized_similarity) per pair.
+"""
+import numpy as np
+from itertools import groupby
+from text import bit_levenshtein
+
+
+def encode_pairs(pairs):
+    """
+    Encodes the strings of all pairs into two concatenated arrays of integer character codes.
+    :param pairs: List of (a, b) string pairs
+    :return: Tuple (a_codes, a_offsets, b_codes, b_offsets) - the codes of string k of each side being
+             codes[offsets[k]:offsets[k + 1]]
+    """
+    chars = {}
+    encoded = []
+    for side in range(2):
+        strings = [pair[side] for pair in pairs]
+        lengths = np.array([len(s) for s in strings], dtype=np.int64)
+        codes = np.fromiter((chars.setdefault(c, len(chars)) for s in strings for c in s),
+                            dtype=np.int64,
+                            count=int(lengths.sum()))
+        encoded.extend([codes, np.concatenate(([0], np.cumsum(lengths)))])
+    return tuple(encoded)
+
+
+def hamming(pairs):
+    """
+    Normalized Hamming similarities of all pairs at once - positions beyond the shorter string count as differing.
+    """
+    if len(pairs) == 0:
+        return []
+    a_codes, a_offsets, b_codes, b_offsets = encode_pairs(pairs)
+    a_lengths, b_lengths = np.diff(a_offsets), np.diff(b_offsets)
+    common = np.minimum(a_lengths, b_lengths)
+    # comparing the first common characters of all pairs in one go
+    owners = np.repeat(np.arange(len(pairs)), common)
+    positions = np.arange(common.sum()) - np.repeat(np.cumsum(common) - common, common)
+    differing = a_codes[a_offsets[owners] + positions] != b_codes[b_offsets[owners] + positions]
+    distances = np.bincount(owners, weights=differing, minlength=len(pairs)).astype(np.int64)
+    distances += np.abs(a_lengths - b_lengths)
+    maxima = np.maximum(a_lengths, b_lengths)
+    return [1 - d / m if m > 0 else 1 for d, m in zip(distances.tolist(), maxima.tolist())]
+
+
+def levenshtein(pairs):
+    """
+    Normalized Levenshtein similarities of all pairs (using the bit-parallel distance).
+    """
+    return [1 - bit_levenshtein(a, b) / max(len(a), len(b)) if len(a) > 0 or len(b) > 0 else 1 for a, b in pairs]
+
+
+def jaro_winkler_pair(s1, s2, prefix_weight=0.1):
+    if s1 == s2:
+        return 1.0
+    s1_len, s2_len = len(s1), len(s2)
+    if not s1_len or not s2_len:
+        return 0.0
+    min_len = min(s1_len, s2_len)
+    search_range = max(0, max(s1_len, s2_len) // 2 - 1)
+    # positions of each character within s2 - the ones before pointers[c] are either matched or out of range
+    positions, pointers = {}, {}
+    for j, c in enumerate(s2):
+        positions.setdefault(c, []).append(j)
+    s1_matched, s2_flags = [], [False] * s2_len
+    for i, c in enumerate(s1):
+        if c not in positions:
+            continue
+        occurrences, p = positions[c], pointers.get(c, 0)
+        low = i - search_range
+        while p < len(occurrences) and occurrences[p] < low:
+            p += 1
+        if p < len(occurrences) and occurrences[p] <= i + search_range:
+            s1_matched.append(c)
+            s2_flags[occurrences[p]] = True
+            p += 1
+        pointers[c] = p
+    common_chars = len(s1_matched)
+    if not common_chars:
+        return 0.0
+    s2_matched = [c for c, flag in zip(s2, s2_flags) if flag]
+    trans_count = sum(c1 != c2 for c1, c2 in zip(s1_matched, s2_matched)) // 2
+    weight = common_chars / s1_len + common_chars / s2_len
+    weight += (common_chars - trans_count) / common_chars
+    weight /= 3
+    if weight <= 0.7:
+        return weight
+    j = min(min_len, 4)
+    i = 0
+    while i < j and s1[i] == s2[i]:
+        i += 1
+    if i:
+        weight += i * prefix_weight * (1.0 - weight)
+    return weight
+
+
+def jaro_winkler(pairs):
+    """
+    Normalized Jaro-Winkler similarities of all pairs - matching characters are looked up through
+    per-character position lists instead of scanning the whole search range.
+    """
+    # 1 - distance reproduces the float rounding of textdistance's normalized_similarity
+    return [1 - (1 - jaro_winkler_pair(a, b)) for a, b in pairs]
+
+
+def mra_code(word):
+    if not word:
+        return word
+    word = word.upper()
+    word = word[0] + ''.join(c for c in word[1:] if c not in 'AEIOU')
+    word = ''.join(char for char, _ in groupby(word))
+    if len(word) > 6:
+        return word[:3] + word[-3:]
+    return word
+
+
+def mra_pair(a, b, codes):
+    if a not in codes:
+        codes[a] = mra_code(a)
+    if b not in codes:
+        codes[b] = mra_code(b)
+    maximum = max(len(codes[a]), len(codes[b]))
+    if not a or not b:
+        similarity = 0
+    elif abs(len(codes[a]) - len(codes[b])) > 2:
+        similarity = 0
+    else:
+        sequences = [list(codes[a]), list(codes[b])]
+        for _ in range(2):
+            # removing matching characters from the common part of both codes
+            min_length = min(map(len, sequences))
+            differing = [chars for chars in zip(*sequences) if chars[0] != chars[1]]
+            sequences = [[chars[side] for chars in differing] + sequences[side][min_length:] for side in range(2)]
+        similarity = maximum - max(map(len, sequences))
+    return 1 - ((maximum - similarity) / maximum if maximum != 0 else 0)
+
+
+def mra(pairs):
+    """
+    Normalized match rating approach similarities of all pairs - codes of recurring strings are computed only once.
+    """
+    codes = {}
+    return [mra_pair(a, b, codes) for a, b in pairs]
+
+
+def wng(pairs, similarity):
+    """
+    Weighted N-gram similarities of all pairs.
+    :param similarity: text.WeightedNGramSimilarity instance that holds the N-gram weighting parameters
+    """
+    return [similarity(a, b) for a, b in pairs]
+
+
+BATCH_METRICS = {
+    'jaro_winkler': jaro_winkler,
+    'hamming': hamming,
+    'levenshtein': levenshtein,
+    'mra': mra
+}
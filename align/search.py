@@ -1,5 +1,76 @@
+import re
+import math
+import logging
+import zlib
+import numpy as np
+from bisect import bisect_left, bisect_right
+from itertools import islice
 from collections import Counter
-from text import ngrams, similarity
+from utils import load_arrays, save_arrays
+
+WORD_PATTERN = re.compile(r'\S+')
+SEED_X_DROP = 2
+SEED_MAX_OCCURRENCES = 100
+ANCHOR_MAX_OCCURRENCES = 1000
+WORD_REFINE_MARGIN = 4
+LSH_BANDS = 16
+LSH_ROWS = 2
+LSH_PRIME = 2 ** 31 - 1
+LSH_MAX_BUCKET = 1000
+NGRAM_MAX_HITS = 2 ** 22
+
+
+def suffix_array(codes):
+    """
+    Sorts all suffixes of an encoded string by prefix doubling.
+    :param codes: Array of (ordered) character codes
+    :return: Array of suffix start positions in lexicographical order of the suffixes
+    """
+    n = len(codes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    _, rank = np.unique(codes, return_inverse=True)
+    rank = rank.astype(np.int64).reshape(-1)
+    order = np.argsort(rank, kind='stable')
+    k = 1
+    while rank.max() < n - 1 and k < n:
+        # sorting by (rank of the first k chars, rank of the next k chars) - suffixes ending early come first
+        second = np.zeros(n, dtype=np.int64)
+        second[:n - k] = rank[k:] + 1
+        keys = rank * (n + 1) + second
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.concatenate(([0], np.cumsum(sorted_keys[1:] != sorted_keys[:-1])))
+        k *= 2
+    return order
+
+
+def lcp_array(codes, suffixes):
+    """
+    Computes the lengths of the longest common prefixes of all neighbouring suffixes of a suffix array
+    in O(N) (Kasai et al.) - the prefix of suffix i + 1 shares at least one character less than the one of suffix i.
+    :param codes: Array of character codes
+    :param suffixes: Suffix array of codes
+    :return: Array with lcp[i] being the common prefix length of suffixes[i - 1] and suffixes[i] (lcp[0] = 0)
+    """
+    n = len(codes)
+    ranks = np.empty(n, dtype=np.int64)
+    ranks[suffixes] = np.arange(n)
+    codes, suffixes, ranks = codes.tolist(), suffixes.tolist(), ranks.tolist()
+    lcp = [0] * n
+    length = 0
+    for start, rank in enumerate(ranks):
+        if rank == 0:
+            length = 0
+            continue
+        other = suffixes[rank - 1]
+        while start + length < n and other + length < n and codes[start + length] == codes[other + length]:
+            length += 1
+        lcp[rank] = length
+        if length > 0:
+            length -= 1
+    return np.array(lcp, dtype=np.int64)
 
 
 class FuzzySearch(object):
@@ -10,21 +81,147 @@ class FuzzySearch(object):
                  match_score=100,
                  mismatch_score=-100,
                  gap_score=-100,
-                 char_similarities=None):
+                 band_width=None,
+                 band_threshold=0.5,
+                 sliding_windows=False,
+                 anchor_size=None,
+                 coarse_to_fine=False,
+                 lsh_window=None,
+                 lsh_recall=False,
+                 batch_cells=4194304,
+                 block_rows=256,
+                 char_similarities=None,
+                 index_path=None,
+                 index_key=None):
         self.text = text
         self.max_candidates = max_candidates
         self.candidate_threshold = candidate_threshold
         self.match_score = match_score
         self.mismatch_score = mismatch_score
         self.gap_score = gap_score
+        self.band_width = band_width
+        self.band_threshold = band_threshold
+        self.sliding_windows = sliding_windows
+        self.anchor_size = anchor_size
+        self.coarse_to_fine = coarse_to_fine
+        self.lsh_window = lsh_window
+        self.lsh_recall = lsh_recall
+        self.batch_cells = batch_cells
+        if lsh_window:
+            # fixed MinHash functions (a * x + b) % LSH_PRIME, so that cached signatures stay valid
+            coefficients = np.random.RandomState(LSH_PRIME % 1000).randint(1, LSH_PRIME, (2, LSH_BANDS * LSH_ROWS))
+            self.lsh_a, self.lsh_b = coefficients.astype(np.int64)
+        if anchor_size and index_key is not None:
+            index_key = 'sa:' + index_key
+        if lsh_window and index_key is not None:
+            index_key = 'lsh{}:{}'.format(lsh_window, index_key)
+        self.block_rows = block_rows
         self.char_similarities = char_similarities
-        self.ngrams = {}
-        for i, ngram in enumerate(ngrams(' ' + text + ' ', 3)):
-            if ngram in self.ngrams:
-                ngram_bucket = self.ngrams[ngram]
-            else:
-                ngram_bucket = self.ngrams[ngram] = []
-            ngram_bucket.append(i)
+        self.char_codes = {}
+        self.score_matrix = None
+        self.stats = Counter()
+        index = load_arrays(index_path, index_key) if index_path else None
+        if index is None:
+            self.build_index()
+            if index_path:
+                try:
+                    self.save_index(index_path, index_key)
+                except OSError as ex:
+                    logging.warning('Unable to cache search index in "{}" - continuing without: {}'
+                                    .format(index_path, ex))
+        else:
+            self.load_index(*index)
+
+    def build_index(self):
+        self.text_codes = self.encode(self.text)
+        # 3-gram index in CSR layout: the (sorted) occurrences of 3-gram ngram_keys[k]
+        # are ngram_positions[ngram_offsets[k]:ngram_offsets[k + 1]]
+        padded_codes = self.encode(' ' + self.text + ' ')
+        self.ngram_base = len(self.char_codes)
+        gram_ids = self.ngram_ids(padded_codes)
+        positions = np.argsort(gram_ids, kind='stable')
+        self.ngram_keys, counts = np.unique(gram_ids, return_counts=True)
+        self.ngram_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.ngram_positions = positions.astype(np.int32 if len(positions) < 2 ** 31 else np.int64)
+        if self.anchor_size:
+            # suffix array over the code points of the text, so that it is ordered like Python strings
+            points = np.fromiter(map(ord, self.text), dtype=np.int64, count=len(self.text))
+            self.suffixes = suffix_array(points).astype(self.ngram_positions.dtype)
+            self.lcp = lcp_array(points, self.suffixes).astype(self.ngram_positions.dtype)
+        if self.lsh_window:
+            self.build_lsh_index(gram_ids)
+
+    def build_lsh_index(self, gram_ids):
+        """
+        Builds a MinHash/LSH index of text windows of lsh_window characters that overlap by half their size:
+        the windows of the buckets with key lsh_keys[b, k] in band b are lsh_windows[b, k].
+        :param gram_ids: 3-gram ids of the text (see ngram_ids)
+        """
+        stride = max(1, self.lsh_window // 2)
+        chunk_starts = np.arange(0, max(1, len(gram_ids)), stride)
+        signatures = np.empty((len(chunk_starts), LSH_BANDS * LSH_ROWS), dtype=np.int64)
+        for k in range(LSH_BANDS * LSH_ROWS):
+            if len(gram_ids) == 0:
+                signatures[:, k] = LSH_PRIME
+                continue
+            chunk_minima = np.minimum.reduceat((self.lsh_a[k] * gram_ids + self.lsh_b[k]) % LSH_PRIME, chunk_starts)
+            # each window consists of two neighbouring chunks
+            signatures[:, k] = np.minimum(chunk_minima, np.append(chunk_minima[1:], LSH_PRIME))
+        band_keys = self.band_keys(signatures)
+        self.lsh_windows = np.argsort(band_keys, axis=1, kind='stable').astype(self.ngram_positions.dtype)
+        self.lsh_keys = np.take_along_axis(band_keys, self.lsh_windows.astype(np.int64), axis=1)
+
+    @staticmethod
+    def band_keys(signatures):
+        """
+        Combines the MinHash values of each band of several signatures into one bucket key.
+        :param signatures: Array of MinHash signatures - one row per signature
+        :return: Array of bucket keys - one row per band
+        """
+        keys = np.zeros((LSH_BANDS, len(signatures)), dtype=np.int64)
+        for row in range(LSH_ROWS):
+            keys = keys * LSH_PRIME + signatures[:, row::LSH_ROWS].T
+        return keys
+
+    def save_index(self, index_path, index_key):
+        """
+        Writes character codes and 3-gram index (plus suffix, LCP and LSH arrays) of the text to a file, so that later
+        instances with the same index_path and index_key can memory-map them instead of building them.
+        """
+        save_arrays(index_path,
+                    index_key,
+                    self.index_arrays(),
+                    chars=sorted(self.char_codes.keys(), key=lambda c: self.char_codes[c])[:self.ngram_base],
+                    ngram_base=self.ngram_base)
+
+    def index_arrays(self):
+        arrays = {
+            'text_codes': self.text_codes,
+            'ngram_keys': self.ngram_keys,
+            'ngram_offsets': self.ngram_offsets,
+            'ngram_positions': self.ngram_positions
+        }
+        if self.anchor_size:
+            arrays['suffixes'] = self.suffixes
+            arrays['lcp'] = self.lcp
+        if self.lsh_window:
+            arrays['lsh_keys'] = self.lsh_keys
+            arrays['lsh_windows'] = self.lsh_windows
+        return arrays
+
+    def load_index(self, arrays, meta):
+        self.char_codes = {c: code for code, c in enumerate(meta['chars'])}
+        self.ngram_base = meta['ngram_base']
+        self.text_codes = arrays['text_codes']
+        self.ngram_keys = arrays['ngram_keys']
+        self.ngram_offsets = arrays['ngram_offsets']
+        self.ngram_positions = arrays['ngram_positions']
+        if self.anchor_size:
+            self.suffixes = arrays['suffixes']
+            self.lcp = arrays['lcp']
+        if self.lsh_window:
+            self.lsh_keys = arrays['lsh_keys']
+            self.lsh_windows = arrays['lsh_windows']
 
     @staticmethod
     def char_pair(a, b):
@@ -38,72 +235,958 @@ class FuzzySearch(object):
             return self.char_similarities[key]
         return self.match_score if a == b else self.mismatch_score
 
-    def sw_align(self, a, start, end):
-        b = self.text[start:end]
-        n, m = len(a), len(b)
-        # building scoring matrix
-        f = [[0]] * (n + 1)
-        for i in range(0, n + 1):
-            f[i] = [0] * (m + 1)
-        for i in range(1, n + 1):
-            f[i][0] = self.gap_score * i
-        for j in range(1, m + 1):
-            f[0][j] = self.gap_score * j
+    def encode(self, s):
+        codes = self.char_codes
+        return np.fromiter((codes.setdefault(c, len(codes)) for c in s), dtype=np.int32, count=len(s))
+
+    def ngram_ids(self, codes):
+        """
+        Maps all 3-grams of an encoded string to integer ids - or -1 for 3-grams containing characters
+        that are not part of the indexed text.
+        :param codes: Character codes of the string
+        :return: Array of 3-gram ids in order of appearance
+        """
+        if len(codes) < 3:
+            return np.zeros(0, dtype=np.int64)
+        codes = codes.astype(np.int64)
+        base = self.ngram_base
+        ids = codes[:-2] * base * base + codes[1:-1] * base + codes[2:]
+        unknown = (codes[:-2] >= base) | (codes[1:-1] >= base) | (codes[2:] >= base)
+        ids[unknown] = -1
+        return ids
+
+    @staticmethod
+    def search_postings(positions, first, last, values, side='left'):
+        """
+        Vectorized binary search within many sorted segments of a position array.
+        :param positions: Position array
+        :param first: Array of segment starts
+        :param last: Array of segment ends (exclusive)
+        :param values: Array with the value to search for per segment
+        :param side: Same as for numpy.searchsorted
+        :return: Array of insertion indices into the position array
+        """
+        first, last = first.copy(), last.copy()
+        while True:
+            active = first < last
+            if not active.any():
+                return first
+            middle = (first + last) // 2
+            middle_values = positions[np.where(active, middle, 0)]
+            right = active & ((middle_values < values) if side == 'left' else (middle_values <= values))
+            first = np.where(right, middle + 1, first)
+            last = np.where(active & ~right, middle, last)
+
+    def find_ngram_postings(self, queries):
+        """
+        Looks up the posting ranges of the 3-grams of several strings within their text intervals at once.
+        :param queries: List of (string, start, end) tuples - end being inclusive
+        :return: Tuple (owners, indices, first, last) of arrays that contain per found 3-gram the index of its query,
+                 its position within the query's string and the range [first, last) of its hits in ngram_positions
+        """
+        gram_ids = [self.ngram_ids(self.encode(' ' + look_for + ' ')) for look_for, _, _ in queries]
+        owners = np.repeat(np.arange(len(queries)), [len(ids) for ids in gram_ids])
+        indices = np.concatenate([np.arange(len(ids)) for ids in gram_ids] + [np.zeros(0, dtype=np.int64)])
+        gram_ids = np.concatenate(gram_ids + [np.zeros(0, dtype=np.int64)])
+        keys = np.searchsorted(self.ngram_keys, gram_ids)
+        found = keys < len(self.ngram_keys)
+        found[found] = self.ngram_keys[keys[found]] == gram_ids[found]
+        owners, indices, keys = owners[found], indices[found], keys[found]
+        starts = np.array([start for _, start, _ in queries], dtype=np.int64)[owners]
+        ends = np.array([end for _, _, end in queries], dtype=np.int64)[owners]
+        first, last = self.ngram_offsets[keys], self.ngram_offsets[keys + 1]
+        first, last = (self.search_postings(self.ngram_positions, first, last, starts),
+                       self.search_postings(self.ngram_positions, first, last, ends, side='right'))
+        return owners, indices, first, last
+
+    def expand_postings(self, owners, indices, first, last):
+        """
+        Expands posting ranges (see find_ngram_postings) into arrays of hits.
+        :return: Tuple (owners, indices, occurrences) of arrays that contain per hit the index of its query,
+                 the position of the 3-gram within the query's string and its position within the text
+        """
+        # expanding all [first, last) position ranges into one array of hits
+        lengths = last - first
+        hit_starts = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum()) - np.repeat(hit_starts - first, lengths)
+        occurrences = self.ngram_positions[positions].astype(np.int64)
+        return np.repeat(owners, lengths), np.repeat(indices, lengths), occurrences
+
+    def get_score_matrix(self):
+        size = len(self.char_codes)
+        if self.score_matrix is None or len(self.score_matrix) < size:
+            chars = sorted(self.char_codes.keys(), key=lambda c: self.char_codes[c])
+            self.score_matrix = np.array([[self.char_similarity(a, b) for b in chars] for a in chars])
+        return self.score_matrix
+
+    def sw_row(self, previous, scores, i):
+        gap_steps = self.gap_score * np.arange(len(previous))
+        row = np.empty_like(previous)
+        row[0] = self.gap_score * i
+        np.maximum(previous[:-1] + scores, previous[1:] + self.gap_score, out=row[1:])
+        np.maximum(row[1:], 0, out=row[1:])
+        # resolves the horizontal (insert) dependency of each cell on its left neighbour as a running maximum
+        return np.maximum.accumulate(row - gap_steps) + gap_steps
+
+    def sw_rows(self, row, a_codes, profile, first, last):
+        """
+        Computes rows of the scoring matrix without keeping them.
+        :param row: Row with index first
+        :param a_codes: Character codes of the string to align
+        :param profile: Substitution scores of all alphabet characters against all characters of the text interval
+        :param first: Index of the row to start from
+        :param last: Index of the last row to compute
+        :return: Produces rows first + 1 to last
+        """
+        for i in range(first + 1, last + 1):
+            row = self.sw_row(row, profile[a_codes[i - 1]], i)
+            yield row
+
+    def sw_traceback(self, a, b, a_codes, profile, top, first, last, i, j, substitutions):
+        """
+        Follows the alignment path from cell (i, j) up to row first by recursively
+        recomputing the rows first to last in halves, so that only blocks of block_rows rows
+        and one row per recursion level are kept in memory.
+        :return: Tuple (i, j, done) with the cell the path left the rows at and if the path ended there
+        """
+        if last - first > self.block_rows:
+            middle = (first + last) // 2
+            if i > middle:
+                middle_row = top
+                for middle_row in self.sw_rows(top, a_codes, profile, first, middle):
+                    pass
+                i, j, done = self.sw_traceback(a, b, a_codes, profile, middle_row, middle, last, i, j, substitutions)
+                if done:
+                    return i, j, done
+            return self.sw_traceback(a, b, a_codes, profile, top, first, middle, i, j, substitutions)
+        f = np.array([top] + list(self.sw_rows(top, a_codes, profile, first, i)))
+        return self.sw_path(a, b, a_codes, profile, f, first, i, j, substitutions)
+
+    def sw_path(self, a, b, a_codes, profile, f, first, i, j, substitutions):
+        """
+        Follows the alignment path from cell (i, j) up to row first of a block of the scoring matrix.
+        :param f: Rows first to i of the scoring matrix
+        :return: Same as sw_traceback
+        """
+        while (i > first or (first == 0 and j > 0)) and f[i - first, j] != 0:
+            if i > 0 and j > 0 and f[i - first, j] == f[i - first - 1, j - 1] + profile[a_codes[i - 1], j - 1]:
+                substitutions[FuzzySearch.char_pair(a[i - 1], b[j - 1])] += 1
+                i, j = i - 1, j - 1
+            elif i > 0 and f[i - first, j] == f[i - first - 1, j] + self.gap_score:
+                i -= 1
+            elif j > 0 and f[i - first, j] == f[i - first, j - 1] + self.gap_score:
+                j -= 1
+            else:
+                raise Exception('Smith–Waterman failure')
+        return i, j, first == 0 or f[i - first, j] == 0
+
+    def sw_local(self, a, b, a_codes, profile):
+        """
+        Local alignment of two sequences in linear space.
+        :param a: Sequence to align (only used for counting substitutions)
+        :param b: Sequence to align with (only used for counting substitutions)
+        :param a_codes: Codes of the elements of a
+        :param profile: Substitution scores of all codes against all elements of b
+        :return: Tuple (first_a, last_a, first_b, last_b, score, substitutions) with a[first_a:last_a]
+                 being aligned with b[first_b:last_b]
+        """
+        n, m = len(a_codes), profile.shape[1]
+        # computing scoring matrix row by row in linear space, only keeping track of its maximum
         max_score = 0
         start_i, start_j = 0, 0
+        for i, row in enumerate(self.sw_rows(self.gap_score * np.arange(m + 1), a_codes, profile, 0, n), 1):
+            j = np.argmax(row[1:]) + 1 if m > 0 else 0
+            if row[j] > max_score:
+                max_score = row[j].item()
+                start_i, start_j = i, int(j)
+        # backtracking - the path only depends on the columns up to start_j
+        substitutions = Counter()
+        i, j, _ = self.sw_traceback(a,
+                                    b,
+                                    a_codes,
+                                    profile[:, :start_j],
+                                    self.gap_score * np.arange(start_j + 1),
+                                    0,
+                                    start_i,
+                                    start_i,
+                                    start_j,
+                                    substitutions)
+        return i, start_i, j, start_j, max_score, substitutions
+
+    def sw_align(self, a, start, end):
+        a_codes = self.encode(a)
+        b_codes = self.text_codes[start:end]
+        # substitution scores of each alphabet character against all characters of b
+        profile = self.get_score_matrix()[:, b_codes]
+        _, _, j, start_j, max_score, substitutions = self.sw_local(a, self.text[start:end], a_codes, profile)
+        align_start = max(start, start + j - 1)
+        align_end = min(end, start + start_j)
+        score = max_score / (self.match_score * max(align_end - align_start, len(a_codes)))
+        return align_start, align_end, score, substitutions
+
+    def sw_align_many(self, a, intervals):
+        """
+        Aligns a string with several text intervals in one vectorized pass by stacking the intervals
+        into a padded array. Intervals whose scoring matrices would exceed batch_cells cells get aligned by sw_align.
+        :param a: String to align
+        :param intervals: List of (start, end) tuples
+        :return: List of sw_align results - one per interval
+        """
+        a_codes = self.encode(a)
+        n = len(a_codes)
+        matrix = self.get_score_matrix()
+        results = [None] * len(intervals)
+        batch = []
+        for index, (start, end) in enumerate(intervals):
+            if (n + 1) * (end - start + 1) > self.batch_cells or n == 0 or end <= start:
+                results[index] = self.sw_align(a, start, end)
+            else:
+                batch.append(index)
+        while len(batch) > 0:
+            # taking as many intervals as fit into batch_cells
+            width = 0
+            for size, index in enumerate(batch, 1):
+                start, end = intervals[index]
+                if (n + 1) * size * (max(width, end - start) + 1) > self.batch_cells:
+                    size -= 1
+                    break
+                width = max(width, end - start)
+            group, batch = batch[:size], batch[size:]
+            b_codes = np.zeros((len(group), width), dtype=self.text_codes.dtype)
+            lengths = np.array([intervals[index][1] - intervals[index][0] for index in group])
+            for k, index in enumerate(group):
+                b_codes[k, :lengths[k]] = self.text_codes[intervals[index][0]:intervals[index][1]]
+            # scoring matrices of all intervals - columns beyond an interval's length are padding
+            gap_steps = self.gap_score * np.arange(width + 1)
+            f = np.empty((n + 1, len(group), width + 1), dtype=matrix.dtype)
+            f[0] = gap_steps
+            for i in range(1, n + 1):
+                row = f[i]
+                row[:, 0] = self.gap_score * i
+                np.maximum(f[i - 1][:, :-1] + matrix[a_codes[i - 1]][b_codes],
+                           f[i - 1][:, 1:] + self.gap_score,
+                           out=row[:, 1:])
+                np.maximum(row[:, 1:], 0, out=row[:, 1:])
+                f[i] = np.maximum.accumulate(row - gap_steps, axis=1) + gap_steps
+            for k, index in enumerate(group):
+                start, end = intervals[index]
+                m = int(lengths[k])
+                # first maximum in row-major order - like the row by row search of sw_local
+                cells = f[1:, k, 1:m + 1]
+                start_i, start_j = np.unravel_index(np.argmax(cells), cells.shape)
+                max_score = cells[start_i, start_j].item()
+                start_i, start_j = (int(start_i) + 1, int(start_j) + 1) if max_score > 0 else (0, 0)
+                substitutions = Counter()
+                _, j, _ = self.sw_path(a,
+                                       self.text[start:end],
+                                       a_codes,
+                                       matrix[:, b_codes[k, :start_j]],
+                                       f[:start_i + 1, k, :start_j + 1],
+                                       0,
+                                       start_i,
+                                       start_j,
+                                       substitutions)
+                align_start = max(start, start + j - 1)
+                align_end = min(end, start + start_j)
+                score = max_score / (self.match_score * max(align_end - align_start, n))
+                results[index] = align_start, align_end, score, substitutions
+        return results
+
+    def sw_align_words(self, a, start, end):
+        """
+        Coarse-to-fine alignment: aligns the words of a with the words of the text interval first and then
+        refines the result by character level alignment within a few words around the aligned words.
+        :param a: String to align
+        :param start: Start of the text interval to align with
+        :param end: End of the text interval to align with
+        :return: Same as sw_align
+        """
+        a_words = WORD_PATTERN.findall(a)
+        b_matches = list(WORD_PATTERN.finditer(self.text, start, end))
+        b_words = [match.group() for match in b_matches]
+        if len(a_words) == 0 or len(b_words) == 0:
+            return self.sw_align(a, start, end)
+        vocabulary = {}
+        a_ids = np.array([vocabulary.setdefault(word, len(vocabulary)) for word in a_words])
+        b_ids = np.array([vocabulary.setdefault(word, len(vocabulary)) for word in b_words])
+        # word matches score like the matches of their characters (plus separator) - mismatches like a single one
+        b_lengths = np.array([len(word) + 1 for word in b_words])
+        profile = np.where(np.arange(len(vocabulary))[:, None] == b_ids[None, :],
+                           self.match_score * b_lengths[None, :],
+                           self.mismatch_score)
+        first_a, last_a, first_b, last_b, score, _ = self.sw_local(a_words, b_words, a_ids, profile)
+        if score <= 0:
+            return self.sw_align(a, start, end)
+        # leaving room for the words of a that are not part of the word alignment and for split or merged words
+        margin = WORD_REFINE_MARGIN + len(a_words) // 8
+        first_b = max(0, first_b - first_a - margin)
+        last_b = min(len(b_matches), last_b + len(a_words) - last_a + margin)
+        self.stats['refined'] += 1
+        return self.sw_align(a, b_matches[first_b].start(), b_matches[last_b - 1].end())
+
+    def sw_align_banded(self, a, start, end, diagonal):
+        """
+        Smith-Waterman alignment that only computes cells within band_width characters of a given diagonal.
+        :param a: String to align
+        :param start: Start of the text interval to align with
+        :param end: End of the text interval to align with
+        :param diagonal: Text offset that is expected to be aligned with the first character of a
+        :return: Same as sw_align - score is a lower bound of the one of sw_align
+        """
+        a_codes = self.encode(a)
+        b_codes = self.text_codes[start:end]
+        n, m = len(a_codes), len(b_codes)
+        width = 2 * self.band_width + 1
+        if n == 0 or m == 0 or width >= m:
+            return self.sw_align(a, start, end)
+        matrix = self.get_score_matrix()
+        low = np.iinfo(matrix.dtype).min // 4 if np.issubdtype(matrix.dtype, np.integer) else -np.inf
+        steps = np.arange(width)
+        gap_steps = self.gap_score * steps
+        # band cell (i, k) represents cell (i, i + base + k) of the full scoring matrix
+        base = diagonal - start - self.band_width
+        f = np.empty((n + 1, width), dtype=matrix.dtype)
+        j = np.arange(n + 1)[:, None] + base + steps
+        valid = (j >= 1) & (j <= m)
+        border = np.where(j == 0, self.gap_score * np.arange(n + 1)[:, None], low)
+        scores = matrix[a_codes[:, None], b_codes[np.clip(j[1:] - 1, 0, m - 1)]]
+        f[0] = np.where((j[0] >= 0) & (j[0] <= m), self.gap_score * j[0], low)
         for i in range(1, n + 1):
-            for j in range(1, m + 1):
-                match = f[i - 1][j - 1] + self.char_similarity(a[i - 1], b[j - 1])
-                insert = f[i][j - 1] + self.gap_score
-                delete = f[i - 1][j] + self.gap_score
-                score = max(0, match, insert, delete)
-                f[i][j] = score
-                if score > max_score:
-                    max_score = score
-                    start_i, start_j = i, j
+            row = f[i - 1] + scores[i - 1]
+            np.maximum(row[:-1], f[i - 1][1:] + self.gap_score, out=row[:-1])
+            row = np.where(valid[i], np.maximum(row, 0), border[i])
+            row = np.maximum.accumulate(row - gap_steps) + gap_steps
+            f[i] = np.where(j[i] <= m, row, low)
+        start_i, start_k = 0, 0
+        band_scores = np.where(valid, f, low)[1:]
+        if band_scores.max() > 0:
+            start_i, start_k = np.unravel_index(np.argmax(band_scores), band_scores.shape)
+            start_i, start_k = int(start_i) + 1, int(start_k)
         # backtracking
         substitutions = Counter()
-        i, j = start_i, start_j
-        while (j > 0 or i > 0) and f[i][j] != 0:
-            if i > 0 and j > 0 and f[i][j] == (f[i - 1][j - 1] + self.char_similarity(a[i - 1], b[j - 1])):
-                substitutions[FuzzySearch.char_pair(a[i - 1], b[j - 1])] += 1
+        i, k = start_i, start_k
+        j = start_j = i + base + k
+        while i > 0 and j > 0 and f[i, k] != 0:
+            if f[i, k] == f[i - 1, k] + matrix[a_codes[i - 1], b_codes[j - 1]]:
+                substitutions[FuzzySearch.char_pair(a[i - 1], self.text[start + j - 1])] += 1
                 i, j = i - 1, j - 1
-            elif i > 0 and f[i][j] == (f[i - 1][j] + self.gap_score):
-                i -= 1
-            elif j > 0 and f[i][j] == (f[i][j - 1] + self.gap_score):
-                j -= 1
+            elif k + 1 < width and f[i, k] == f[i - 1, k + 1] + self.gap_score:
+                i, k = i - 1, k + 1
+            elif k > 0 and f[i, k] == f[i, k - 1] + self.gap_score:
+                j, k = j - 1, k - 1
             else:
                 raise Exception('Smith–Waterman failure')
+        if f[i, k] != 0:
+            # remaining path runs along the matrix border
+            j = 0
         align_start = max(start, start + j - 1)
         align_end = min(end, start + start_j)
-        score = f[start_i][start_j] / (self.match_score * max(align_end - align_start, n))
+        score = f[start_i, start_k].item() / (self.match_score * max(align_end - align_start, n))
         return align_start, align_end, score, substitutions
 
-    def find_best(self, look_for, start=0, end=-1):
-        end = len(self.text) if end < 0 else end
-        if end - start < 2 * len(look_for):
-            return self.sw_align(look_for, start, end)
+    def window_candidates(self, owners, occurrences, window_sizes):
+        """
+        Partitions the text into windows of query length and ranks them by their number of 3-gram hits.
+        :return: List with one list of (window start, 3-gram hits) tuples per query
+        """
+        # counting 3-gram hits per (query, window) pair
+        stride = len(self.text) // window_sizes.min() + 2
+        hit_windows = owners * stride + occurrences // window_sizes[owners]
+        windows, first_hits, window_grams = np.unique(hit_windows, return_index=True, return_counts=True)
+        window_bounds = np.searchsorted(windows // stride, np.arange(len(window_sizes) + 1))
+        candidates = []
+        for query, window_size in enumerate(window_sizes.tolist()):
+            first, last = window_bounds[query], window_bounds[query + 1]
+            # windows with most 3-gram hits first - ties in order of their first hit
+            order = first + np.lexsort((first_hits[first:last], -window_grams[first:last]))
+            candidates.append(list(zip(((windows[order] % stride) * window_size).tolist(),
+                                       window_grams[order].tolist())))
+        return candidates
+
+    def density_candidates(self, owners, occurrences, window_sizes):
+        """
+        Ranks windows of query length that start at any 3-gram hit by their number of 3-gram hits
+        (sliding window sums) and picks the densest ones that do not overlap.
+        :return: List with one list of (window start, 3-gram hits) tuples per query
+        """
+        stride = len(self.text) + int(window_sizes.max()) + 2
+        hit_keys = np.sort(owners * stride + occurrences)
+        hit_positions = hit_keys - owners * stride
+        window_grams = np.searchsorted(hit_keys, hit_keys + window_sizes[owners]) - np.arange(len(hit_keys))
+        hit_bounds = np.searchsorted(owners, np.arange(len(window_sizes) + 1))
+        candidates = []
+        for query, window_size in enumerate(window_sizes.tolist()):
+            positions = hit_positions[hit_bounds[query]:hit_bounds[query + 1]]
+            grams = window_grams[hit_bounds[query]:hit_bounds[query + 1]].copy()
+            query_candidates = []
+            while len(query_candidates) < self.max_candidates and len(grams) > 0:
+                best = np.argmax(grams)
+                if grams[best] <= 0:
+                    break
+                query_candidates.append((int(positions[best]), int(grams[best])))
+                grams[np.abs(positions - positions[best]) < window_size] = 0
+            candidates.append(query_candidates)
+        return candidates
+
+    def score_bound(self, char_counts, hits, start, end):
+        """
+        Computes an upper bound of the score sw_align can return for a string within a text interval.
+        :param char_counts: Number of occurrences of each character code within the string
+        :param hits: Number of 3-gram hits of the string within the text interval
+        :param start: Start of the text interval
+        :param end: End of the text interval
+        :return: Upper bound of the normalized Smith-Waterman score
+        """
+        n = int(char_counts.sum())
+        matrix = self.get_score_matrix()
+        if n == 0 or self.match_score <= 0 or self.gap_score > 0:
+            return math.inf
+        if (matrix - np.diag(matrix.diagonal())).max() > 0 or matrix.diagonal().max() > self.match_score:
+            return max(0, matrix.max()) * min(n, end - start) / (self.match_score * n)
+        # only matches of equal characters can contribute to the score
+        text_counts = np.bincount(self.text_codes[start:end], minlength=len(char_counts))
+        matches = int(np.minimum(char_counts, text_counts[:len(char_counts)]).sum())
+        # q-gram lemma: aligning l characters with k edits leaves at least l - 2 - 3k of their 3-grams as hits,
+        # so a local alignment consuming l characters of the string scores at most
+        # match_score * l - penalty * max(0, l - 2 - hits) / 3
+        penalty = -max(self.mismatch_score, self.gap_score)
+        length_bound = max(self.match_score * length - penalty * max(0, length - 2 - hits) / 3
+                           for length in [n, min(n, hits + 2)])
+        return min(self.match_score * matches, length_bound) / (self.match_score * n)
+
+    def longest_match(self, look_for):
+        """
+        Finds the longest prefix of a string that occurs in the text by binary search on the suffix array.
+        :param look_for: String
+        :return: Tuple (length, index) - the prefix length and the index of one of its occurrences
+                 within the suffix array
+        """
+        n, m = len(self.suffixes), len(look_for)
+        first, last = 0, n
+        while first < last:
+            middle = (first + last) // 2
+            suffix = int(self.suffixes[middle])
+            if self.text[suffix:suffix + m] < look_for:
+                first = middle + 1
+            else:
+                last = middle
+        # the longest match is shared with one of the two suffixes that enclose the insertion point
+        length, best = 0, first
+        for index in (first - 1, first):
+            if 0 <= index < n:
+                suffix = int(self.suffixes[index])
+                common = 0
+                for a, b in zip(self.text[suffix:suffix + m], look_for):
+                    if a != b:
+                        break
+                    common += 1
+                if common > length:
+                    length, best = common, index
+        return length, best
+
+    def match_range(self, index, length, limit):
+        """
+        Expands a suffix array index to the range of all suffixes that share its first length characters.
+        :param index: Suffix array index
+        :param length: Prefix length
+        :param limit: Maximum number of suffixes to look at per side
+        :return: Range (first, last) of suffix array indices - or None if it exceeds the limit
+        """
+        # lcp[i] >= length means that suffixes i - 1 and i share the prefix (lcp[0] = 0 stops the search)
+        before = np.flatnonzero(self.lcp[max(0, index - limit):index + 1][::-1] < length)
+        after = np.flatnonzero(self.lcp[index + 1:index + limit + 1] < length)
+        if len(before) == 0 or (len(after) == 0 and index + limit + 1 < len(self.lcp)):
+            return None
+        return index - int(before[0]), index + (int(after[0]) if len(after) > 0 else len(self.lcp) - 1 - index)
+
+    def anchor_candidates(self, look_for, start, end):
+        """
+        Looks up long exact matches (anchors) of a string's substrings within a text interval and turns the
+        text diagonals that got the most anchor characters into alignment candidates (see align_candidates).
+        :param look_for: String
+        :param start: Start of the text interval
+        :param end: End of the text interval
+        :return: List of (interval start, interval end, rank score, 3-gram hits, diagonal) tuples
+        """
+        m = len(look_for)
+        votes = Counter()
+        i = 0
+        while i <= m - self.anchor_size:
+            length, index = self.longest_match(look_for[i:])
+            if length < self.anchor_size:
+                i += 1
+                continue
+            # anchors with too many occurrences are not specific enough to vote
+            occurrences = self.match_range(index, length, ANCHOR_MAX_OCCURRENCES)
+            if occurrences is not None:
+                positions = self.suffixes[occurrences[0]:occurrences[1] + 1].astype(np.int64)
+                positions = positions[(positions >= start) & (positions + length <= end)]
+                if 0 < len(positions) <= self.max_candidates:
+                    for position in positions:
+                        votes[int(position) - i] += length
+            i += length
+        slack = max(1, m // 4)
+        candidates = []
+        for diagonal, _ in votes.most_common():
+            if any(abs(diagonal - other) <= slack for _, _, _, _, other in candidates):
+                continue
+            score = sum(v for d, v in votes.items() if abs(d - diagonal) <= slack)
+            candidates.append((max(start, diagonal - slack), min(end, diagonal + m + slack), score, math.inf, diagonal))
+        return sorted(candidates, key=lambda c: c[2], reverse=True)
+
+    def lsh_candidates(self, look_for, start, end):
+        """
+        Looks up the LSH buckets of the MinHash signatures of a string's windows and turns the text windows
+        that collided most often into alignment candidates (see align_candidates).
+        :param look_for: String
+        :param start: Start of the text interval
+        :param end: End of the text interval
+        :return: List of (interval start, interval end, rank score, 3-gram hits, diagonal) tuples
+        """
+        stride = max(1, self.lsh_window // 2)
+        offsets = list(range(0, max(1, len(look_for) - self.lsh_window + stride), stride))
+        window_starts = []
+        for offset in offsets:
+            gram_ids = self.ngram_ids(self.encode(' ' + look_for[offset:offset + self.lsh_window] + ' '))
+            if len(gram_ids) == 0:
+                continue
+            signature = ((self.lsh_a[:, None] * gram_ids[None, :] + self.lsh_b[:, None]) % LSH_PRIME).min(axis=1)
+            for band, key in enumerate(self.band_keys(signature[None, :])[:, 0]):
+                first = np.searchsorted(self.lsh_keys[band], key)
+                last = np.searchsorted(self.lsh_keys[band], key, side='right')
+                # huge buckets stem from very common text and are not specific enough to vote
+                if 0 < last - first <= LSH_MAX_BUCKET:
+                    window_starts.append(self.lsh_windows[band][first:last].astype(np.int64) * stride - offset)
+        if len(window_starts) == 0:
+            return []
+        window_starts, collisions = np.unique(np.concatenate(window_starts), return_counts=True)
+        in_interval = (window_starts + len(look_for) >= start) & (window_starts <= end)
+        window_starts, collisions = window_starts[in_interval], collisions[in_interval]
+        order = np.argsort(-collisions, kind='stable')
+        margin = stride + len(look_for) // 4
+        candidates = []
+        for window_start, window_collisions in zip(window_starts[order].tolist(), collisions[order].tolist()):
+            if len(candidates) == self.max_candidates:
+                break
+            if any(abs(window_start - other) < margin for other, _ in candidates):
+                continue
+            candidates.append((window_start, window_collisions))
+        return [(max(start, window_start - margin),
+                 min(end, window_start + len(look_for) + margin),
+                 collisions,
+                 math.inf,
+                 None) for window_start, collisions in candidates]
+
+    def window_intervals(self, look_for, start, end, candidates, occurrences, indices):
+        """
+        Turns candidate windows into alignment candidates (see align_candidates).
+        :param candidates: List of (window start, 3-gram hits) tuples
+        :param occurrences: Text positions of all 3-gram hits of look_for
+        :param indices: Positions of the according 3-grams within look_for
+        :return: Produces (interval start, interval end, rank score, 3-gram hits, diagonal) tuples
+        """
         window_size = len(look_for)
-        windows = {}
-        for i, ngram in enumerate(ngrams(' ' + look_for + ' ', 3)):
-            if ngram in self.ngrams:
-                ngram_bucket = self.ngrams[ngram]
-                for occurrence in ngram_bucket:
-                    if occurrence < start or occurrence > end:
-                        continue
-                    window = occurrence // window_size
-                    windows[window] = (windows[window] + 1) if window in windows else 1
-        candidate_windows = sorted(windows.keys(), key=lambda w: windows[w], reverse=True)
+        # margin of text around a candidate window that gets aligned
+        margin = window_size // 2 if self.sliding_windows else window_size
+        for window_start, grams in candidates:
+            interval_start = max(start, window_start - margin)
+            interval_end = min(end, window_start + window_size + margin)
+            hits = np.count_nonzero((occurrences >= interval_start) & (occurrences <= interval_end))
+            diagonal = None
+            if self.band_width:
+                # median text offset of the query's first character as implied by the window's 3-gram hits
+                in_window = (occurrences >= window_start) & (occurrences < window_start + window_size)
+                offsets = np.sort(occurrences[in_window] - indices[in_window])
+                diagonal = int(offsets[len(offsets) // 2])
+            yield interval_start, interval_end, grams, hits, diagonal
+
+    def align_candidates(self, look_for, candidates):
+        """
+        Aligns a string with candidate text intervals and returns the best alignment.
+        :param look_for: String to align
+        :param candidates: Iterable of (interval start, interval end, rank score, 3-gram hits, diagonal) tuples
+            in order of descending rank score. 3-gram hits can be math.inf, if unknown.
+            Diagonal is the text offset expected to be aligned with the first character of look_for (or None).
+        :return: Best (start, end, score, substitutions) tuple
+        """
+        if self.batch_cells and not self.band_width and not self.coarse_to_fine:
+            return self.align_candidates_batched(look_for, candidates)
+        char_counts = np.bincount(self.encode(look_for), minlength=len(self.char_codes))
         best = (-1, -1, 0, None)
-        last_window_grams = 0.1
-        for window in candidate_windows[:self.max_candidates]:
-            ngram_factor = (windows[window] / last_window_grams)
-            if ngram_factor < self.candidate_threshold:
+        last_rank_score = 0.1
+        for interval_start, interval_end, rank_score, hits, diagonal in islice(candidates, self.max_candidates):
+            if rank_score / last_rank_score < self.candidate_threshold:
                 break
-            last_window_grams = windows[window]
-            interval_start = max(start, int((window - 1) * window_size))
-            interval_end = min(end, int((window + 2) * window_size))
-            search_result = self.sw_align(look_for, interval_start, interval_end)
+            last_rank_score = rank_score
+            if self.score_bound(char_counts, hits, interval_start, interval_end) <= best[2]:
+                self.stats['pruned'] += 1
+                continue
+            self.stats['aligned'] += 1
+            sw_align = self.sw_align_words if self.coarse_to_fine else self.sw_align
+            if self.band_width and diagonal is not None:
+                search_result = self.sw_align_banded(look_for, interval_start, interval_end, diagonal)
+                if search_result[2] < self.band_threshold:
+                    search_result = sw_align(look_for, interval_start, interval_end)
+            else:
+                search_result = sw_align(look_for, interval_start, interval_end)
             if search_result[2] > best[2]:
                 best = search_result
         return best
+
+    def align_candidates_batched(self, look_for, candidates):
+        """
+        Variant of align_candidates that aligns candidate intervals in groups of up to batch_cells scoring matrix
+        cells at once (see sw_align_many). Candidates get aligned in descending order of their score bounds
+        and in groups of doubling size, so that candidates whose bounds can no longer beat the best score are pruned.
+        """
+        char_counts = np.bincount(self.encode(look_for), minlength=len(self.char_codes))
+        n = len(look_for)
+        pending = []
+        last_rank_score = 0.1
+        for index, (interval_start, interval_end, rank_score, hits, _) in enumerate(islice(candidates,
+                                                                                           self.max_candidates)):
+            if rank_score / last_rank_score < self.candidate_threshold:
+                break
+            last_rank_score = rank_score
+            bound = self.score_bound(char_counts, hits, interval_start, interval_end)
+            pending.append((bound, index, interval_start, interval_end))
+        pending.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        # ties are won by the best ranked candidate (like in align_candidates) - but never against the empty result
+        best, best_index = (-1, -1, 0, None), -1
+        # doubling group sizes - the first groups set the score that later ones have to be able to beat
+        max_size = 1
+        while len(pending) > 0:
+            promising = [c for c in pending if c[0] > best[2] or (c[0] == best[2] and c[1] < best_index)]
+            self.stats['pruned'] += len(pending) - len(promising)
+            if len(promising) == 0:
+                break
+            width = 0
+            for size, (_, _, interval_start, interval_end) in enumerate(promising[:max_size], 1):
+                width = max(width, interval_end - interval_start)
+                if size > 1 and (n + 1) * size * (width + 1) > self.batch_cells:
+                    size -= 1
+                    break
+            group, pending = promising[:size], promising[size:]
+            max_size *= 2
+            self.stats['aligned'] += len(group)
+            for (_, index, _, _), search_result in zip(group, self.sw_align_many(look_for,
+                                                                                   [c[2:] for c in group])):
+                if search_result[2] > best[2] or (search_result[2] == best[2] and index < best_index):
+                    best, best_index = search_result, index
+        return best
+
+    def find_best_many(self, transcripts, intervals):
+        """
+        Finds the best matches of several strings within their text intervals.
+        3-gram lookup and candidate window counting is done for all strings at once.
+        :param transcripts: Strings to look for
+        :param intervals: One (start, end) tuple per string - end < 0 for the end of the text
+        :return: List with one (start, end, score, substitutions) tuple per string (see find_best)
+        """
+        results = [None] * len(transcripts)
+        queries, query_indices = [], []
+        for index, (look_for, (start, end)) in enumerate(zip(transcripts, intervals)):
+            end = len(self.text) if end < 0 else end
+            if end - start < 2 * len(look_for):
+                results[index] = (self.sw_align_words if self.coarse_to_fine else self.sw_align)(look_for, start, end)
+            else:
+                queries.append((look_for, start, end))
+                query_indices.append(index)
+        for index, result in zip(query_indices, self.search_many(queries) if len(queries) > 0 else []):
+            results[index] = result
+        return results
+
+    def search_many(self, queries):
+        """
+        Candidate search and alignment for find_best_many.
+        :param queries: List of (string, start, end) tuples
+        :return: List of results
+        """
+        results = [None] * len(queries)
+        remaining = list(range(len(queries)))
+        # first stage candidate generators - queries without candidates fall through to the next one
+        for enabled, get_candidates, stat in [(self.anchor_size, self.anchor_candidates, 'anchored'),
+                                              (self.lsh_window, self.lsh_candidates, 'hashed')]:
+            if not enabled:
+                continue
+            unresolved = []
+            for query in remaining:
+                look_for, start, end = queries[query]
+                candidates = get_candidates(look_for, start, end)
+                if len(candidates) > 0:
+                    self.stats[stat] += 1
+                    results[query] = self.align_candidates(look_for, candidates)
+                    if stat == 'hashed' and self.lsh_recall:
+                        self.check_lsh_recall(queries[query], results[query])
+                else:
+                    unresolved.append(query)
+            remaining = unresolved
+        for query, result in zip(remaining, self.search_ngrams([queries[query] for query in remaining])):
+            results[query] = result
+        return results
+
+    def check_lsh_recall(self, query, result):
+        """
+        Compares the result of an LSH based search with the one of the 3-gram based search and counts in stats,
+        if the LSH search found a match that overlaps or outscores the 3-gram search's one.
+        """
+        reference = self.search_ngrams([query])[0]
+        self.stats['lsh-checked'] += 1
+        if result[2] >= reference[2] or (result[0] < reference[1] and reference[0] < result[1]):
+            self.stats['lsh-recalled'] += 1
+
+    def search_ngrams(self, queries):
+        """
+        3-gram based candidate search and alignment.
+        Queries are processed in chunks of consecutive queries with no more than NGRAM_MAX_HITS 3-gram hits
+        (or of one query), so that the hit arrays of many queries over long texts stay bounded.
+        :param queries: List of (string, start, end) tuples
+        :return: List of results
+        """
+        results = []
+        if len(queries) == 0:
+            return results
+        owners, indices, first, last = self.find_ngram_postings(queries)
+        hit_counts = np.concatenate(([0], np.cumsum(np.bincount(owners,
+                                                                weights=last - first,
+                                                                minlength=len(queries)).astype(np.int64))))
+        chunk_start = 0
+        while chunk_start < len(queries):
+            chunk_end = int(np.searchsorted(hit_counts, hit_counts[chunk_start] + NGRAM_MAX_HITS, side='right')) - 1
+            chunk_end = min(len(queries), max(chunk_start + 1, chunk_end))
+            rows = slice(*np.searchsorted(owners, [chunk_start, chunk_end]).tolist())
+            results.extend(self.search_ngram_chunk(queries[chunk_start:chunk_end],
+                                                   *self.expand_postings(owners[rows] - chunk_start,
+                                                                         indices[rows],
+                                                                         first[rows],
+                                                                         last[rows])))
+            chunk_start = chunk_end
+        return results
+
+    def search_ngram_chunk(self, queries, owners, indices, occurrences):
+        """
+        Candidate search and alignment of a chunk of queries (see search_ngrams) by their 3-gram hits.
+        """
+        results = []
+        window_sizes = np.array([max(1, len(look_for)) for look_for, _, _ in queries], dtype=np.int64)
+        if self.sliding_windows:
+            candidates = self.density_candidates(owners, occurrences, window_sizes)
+        else:
+            candidates = self.window_candidates(owners, occurrences, window_sizes)
+        hit_bounds = np.searchsorted(owners, np.arange(len(queries) + 1))
+        for query, (look_for, start, end) in enumerate(queries):
+            hits = slice(hit_bounds[query], hit_bounds[query + 1])
+            results.append(self.align_candidates(look_for, self.window_intervals(look_for,
+                                                                                 start,
+                                                                                 end,
+                                                                                 candidates[query],
+                                                                                 occurrences[hits],
+                                                                                 indices[hits])))
+        return results
+
+    def find_best(self, look_for, start=0, end=-1):
+        return self.find_best_many([look_for], [(start, end)])[0]
+
+
+class SeedSearch(FuzzySearch):
+    """
+    Search engine for very long texts that (instead of counting 3-gram hits) looks up exact seeds of
+    seed_size consecutive words, extends them without gaps and aligns only the regions around the best chains
+    of extended seeds (like BLAST does). Strings without seeds fall back to the 3-gram search.
+    """
+    def __init__(self, text, seed_size=2, **kwargs):
+        self.seed_size = seed_size
+        if kwargs.get('index_key') is not None:
+            # the index also contains the 3-gram index for the fallback search
+            kwargs['index_key'] = 'seed{}+3gram:{}'.format(seed_size, kwargs['index_key'])
+        super(SeedSearch, self).__init__(text, **kwargs)
+
+    def build_index(self):
+        super(SeedSearch, self).build_index()
+        words = list(WORD_PATTERN.finditer(self.text))
+        self.word_starts = np.fromiter((word.start() for word in words), dtype=np.int64, count=len(words))
+        self.word_ends = np.fromiter((word.end() for word in words), dtype=np.int64, count=len(words))
+        self.word_ids = SeedSearch.hash_words(word.group() for word in words)
+        # seed index in CSR layout: the (sorted) word indices of seed seed_keys[k]
+        # are seed_positions[seed_offsets[k]:seed_offsets[k + 1]]
+        seed_ids = self.seed_ids(self.word_ids)
+        positions = np.argsort(seed_ids, kind='stable')
+        self.seed_keys, counts = np.unique(seed_ids, return_counts=True)
+        self.seed_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.seed_positions = positions.astype(np.int32 if len(positions) < 2 ** 31 else np.int64)
+
+    def index_arrays(self):
+        arrays = super(SeedSearch, self).index_arrays()
+        arrays.update({
+            'word_starts': self.word_starts,
+            'word_ends': self.word_ends,
+            'word_ids': self.word_ids,
+            'seed_keys': self.seed_keys,
+            'seed_offsets': self.seed_offsets,
+            'seed_positions': self.seed_positions
+        })
+        return arrays
+
+    def load_index(self, arrays, meta):
+        super(SeedSearch, self).load_index(arrays, meta)
+        for name in ['word_starts', 'word_ends', 'word_ids', 'seed_keys', 'seed_offsets', 'seed_positions']:
+            setattr(self, name, arrays[name])
+
+    @staticmethod
+    def hash_words(words):
+        return np.array([zlib.crc32(word.encode('utf-8')) for word in words], dtype=np.uint64)
+
+    def seed_ids(self, word_ids):
+        count = len(word_ids) - self.seed_size + 1
+        seed_ids = np.zeros(max(0, count), dtype=np.uint64)
+        for i in range(self.seed_size if count > 0 else 0):
+            seed_ids = seed_ids * np.uint64(1000003) + word_ids[i:i + count]
+        return seed_ids
+
+    def find_seeds(self, query_ids, first_word, last_word):
+        """
+        Looks up all seeds of a query within a range of text words.
+        :param query_ids: Word ids of the query
+        :param first_word: Index of the first text word of the range
+        :param last_word: Index of the text word behind the range
+        :return: Tuple (query_words, text_words) of arrays with the first query and text word index per seed hit -
+                 seeds with more than SEED_MAX_OCCURRENCES hits get skipped, if there are less frequent ones
+        """
+        seed_ids = self.seed_ids(query_ids)
+        keys = np.searchsorted(self.seed_keys, seed_ids)
+        found = keys < len(self.seed_keys)
+        found[found] = self.seed_keys[keys[found]] == seed_ids[found]
+        query_words, keys = np.flatnonzero(found), keys[found]
+        first, last = self.seed_offsets[keys], self.seed_offsets[keys + 1]
+        bounds = np.full(len(keys), first_word), np.full(len(keys), last_word - self.seed_size + 1)
+        first, last = (self.search_postings(self.seed_positions, first, last, bounds[0]),
+                       self.search_postings(self.seed_positions, first, last, bounds[1]))
+        lengths = np.maximum(0, last - first)
+        # masking seeds that are too frequent within the range (e.g. "of the") - unless there are only such
+        frequent = lengths > SEED_MAX_OCCURRENCES
+        if frequent.all() and len(lengths) > 0:
+            frequent = lengths > lengths.min()
+        lengths[frequent] = 0
+        hit_starts = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum()) - np.repeat(hit_starts - first, lengths)
+        return np.repeat(query_words, lengths), self.seed_positions[positions].astype(np.int64)
+
+    def extend_seed(self, query_ids, query_word, text_word, first_word, last_word):
+        """
+        Extends a seed hit without gaps to both sides till its score drops SEED_X_DROP below its maximum.
+        Matching words score 1 and non-matching ones -1.
+        :return: Tuple (first, last, score) with the query word range [first, last) of the extension and its score
+        """
+        diagonal = text_word - query_word
+        first, last = query_word, query_word + self.seed_size
+        total = 0
+        for direction in [-1, 1]:
+            score = best = 0
+            q = first - 1 if direction < 0 else last
+            while 0 <= q < len(query_ids) and first_word <= q + diagonal < last_word:
+                score += 1 if query_ids[q] == self.word_ids[q + diagonal] else -1
+                if score > best:
+                    best = score
+                    if direction < 0:
+                        first = q
+                    else:
+                        last = q + 1
+                elif best - score >= SEED_X_DROP:
+                    break
+                q += direction
+            total += best
+        return first, last, self.seed_size + total
+
+    def chain_extensions(self, extensions, max_drift):
+        """
+        Computes best chains of extensions that are in the same order in query and text
+        and whose diagonals differ by no more than max_drift words - in O(N log N) using a segment tree
+        of the best chain scores per diagonal.
+        :param extensions: List of (first, last, diagonal, score) tuples
+        :return: List of (score, members) tuples of non-overlapping chains - best chains first
+        """
+        if len(extensions) == 0:
+            return []
+        extensions = sorted(extensions, key=lambda e: (e[0], e[2]))
+        diagonals = sorted(set(e[2] for e in extensions))
+        size = 1
+        while size < len(diagonals):
+            size *= 2
+        # (best chain score, last extension) per diagonal range
+        tree = [(0, -1)] * (2 * size)
+        by_last = sorted(range(len(extensions)), key=lambda e: extensions[e][1])
+        scores, predecessors = [], []
+        inserted = 0
+        for j, (first, _, diagonal, score) in enumerate(extensions):
+            # extensions ending (in the query) before this one starts become possible predecessors
+            while inserted < len(by_last) and extensions[by_last[inserted]][1] <= first:
+                i = by_last[inserted]
+                node = size + bisect_left(diagonals, extensions[i][2])
+                while node > 0 and tree[node] < (scores[i], i):
+                    tree[node] = (scores[i], i)
+                    node //= 2
+                inserted += 1
+            best = (0, -1)
+            low = size + bisect_left(diagonals, diagonal - max_drift)
+            high = size + bisect_right(diagonals, diagonal + max_drift)
+            while low < high:
+                if low & 1:
+                    best = max(best, tree[low])
+                    low += 1
+                if high & 1:
+                    high -= 1
+                    best = max(best, tree[high])
+                low //= 2
+                high //= 2
+            scores.append(best[0] + score)
+            predecessors.append(best[1] if best[0] > 0 else None)
+        chains, used = [], set()
+        for j in sorted(range(len(extensions)), key=lambda e: scores[e], reverse=True):
+            members = []
+            while j is not None and j not in used:
+                members.insert(0, extensions[j])
+                used.add(j)
+                j = predecessors[j]
+            if len(members) > 0:
+                chains.append((sum(e[3] for e in members), members))
+        return sorted(chains, key=lambda c: c[0], reverse=True)
+
+    def search_many(self, queries):
+        results = [self.search(look_for, start, end) for look_for, start, end in queries]
+        # queries without any seed (e.g. with less than seed_size words) get searched by their 3-grams
+        unseeded = [query for query, result in enumerate(results) if result is None]
+        for query, result in zip(unseeded, self.search_ngrams([queries[query] for query in unseeded])):
+            results[query] = result
+        return results
+
+    def search(self, look_for, start, end):
+        """
+        Seed based candidate search and alignment of one string.
+        :return: Result (see find_best) or None, if the string has no seed within the text interval
+        """
+        query_ids = SeedSearch.hash_words(WORD_PATTERN.findall(look_for))
+        first_word = int(np.searchsorted(self.word_starts, start))
+        last_word = int(np.searchsorted(self.word_ends, end, side='right'))
+        extensions, covered = [], set()
+        for query_word, text_word in zip(*self.find_seeds(query_ids, first_word, last_word)):
+            diagonal = int(text_word - query_word)
+            if (diagonal, query_word) in covered:
+                continue
+            first, last, score = self.extend_seed(query_ids, int(query_word), int(text_word), first_word, last_word)
+            covered.update((diagonal, q) for q in range(first, last))
+            extensions.append((first, last, diagonal, score))
+        if len(extensions) == 0:
+            return None
+        slack = max(1, len(query_ids) // 4)
+
+        def chain_intervals():
+            for chain_score, members in self.chain_extensions(extensions, slack):
+                # text words the whole query would cover according to the diagonals of the chain's ends
+                interval_first = max(first_word, members[0][2] - slack)
+                interval_last = min(last_word - 1, members[-1][2] + len(query_ids) - 1 + slack)
+                yield (max(start, int(self.word_starts[interval_first])),
+                       min(end, int(self.word_ends[interval_last])),
+                       chain_score,
+                       math.inf,
+                       None)
+        return self.align_candidates(look_for, chain_intervals())
@@ -1,9 +1,12 @@
 from __future__ import absolute_import, division, print_function
 
 import codecs
+import numpy as np
+from array import array
+from bisect import bisect_right
 from six.moves import range
 from collections import Counter
-from utils import enweight
+from utils import enweight, IntervalIndex, load_arrays, save_arrays
 
 
 class Alphabet(object):
@@ -49,58 +52,226 @@ class Alphabet(object):
         return self._config_file
 
 
+class TranslationTable(dict):
+    """
+    Lazily filled str.translate table - the translation of a character gets computed on its first lookup.
+    """
+    def __init__(self, translate_char):
+        super(TranslationTable, self).__init__()
+        self.translate_char = translate_char
+
+    def __missing__(self, key):
+        value = self[key] = self.translate_char(chr(key))
+        return value
+
+
+CHAR_DROP, CHAR_KEEP, CHAR_SPACE, CHAR_SEPARATOR = 'd', 'k', 's', '|'
+
+
 class TextCleaner(object):
     def __init__(self, alphabet, to_lower=True, normalize_space=True, dashes_to_ws=True):
         self.alphabet = alphabet
         self.to_lower = to_lower
         self.normalize_space = normalize_space
         self.dashes_to_ws = dashes_to_ws
-        self.original_text = ''
-        self.clean_text = ''
-        self.positions = []
-        self.meta = []
+        # texts get joined on first access
+        self.original_parts = []
+        self.clean_parts = []
+        self.original_length = 0
+        # original text offset of every clean character
+        self.positions = array('I')
+        # meta of the clean characters as runs - meta_values[i] applies from clean offset meta_starts[i] on
+        self.meta_starts = []
+        self.meta_values = []
+        # interval index of the runs with meta - built on first use
+        self.meta_index = None
+        self.replace_table = TranslationTable(self.replace_char)
+        self.class_table = TranslationTable(self.classify_char)
+
+    @property
+    def original_text(self):
+        if len(self.original_parts) != 1:
+            self.original_parts = [''.join(self.original_parts)]
+        return self.original_parts[0]
+
+    @property
+    def clean_text(self):
+        if len(self.clean_parts) != 1:
+            self.clean_parts = [''.join(self.clean_parts)]
+        return self.clean_parts[0]
+
+    def replace_char(self, c):
+        if self.dashes_to_ws and c == '-' and not self.alphabet.has_label('-'):
+            return ' '
+        if self.normalize_space and c.isspace():
+            return ' '
+        return c
+
+    def classify_char(self, c):
+        if self.normalize_space and c.isspace():
+            return CHAR_SPACE
+        return CHAR_KEEP if self.alphabet.has_label(c) else CHAR_DROP
+
+    def add_meta_run(self, clean_offset, meta):
+        if len(self.meta_values) == 0 or self.meta_values[-1] is not meta:
+            self.meta_starts.append(clean_offset)
+            self.meta_values.append(meta)
+
+    def clean_texts(self, original_texts, metas, separated):
+        """
+        Cleans texts in one vectorized pass and appends them.
+        :param original_texts: List of texts
+        :param metas: List of meta values - one per text
+        :param separated: If each text should be preceded by a separating space (only one text allowed otherwise)
+        """
+        self.meta_index = None
+        prepared_texts = [text.lower() for text in original_texts] if self.to_lower else original_texts
+        separator = ' ' if separated else ''
+        replaced_text = ''.join(separator + text for text in prepared_texts).translate(self.replace_table)
+        classes = np.frombuffer(replaced_text.translate(self.class_table).encode('ascii'), dtype=np.uint8).copy()
+        # lowering may change text lengths - shifting positions within the prepared texts to original ones
+        prepared_lengths = np.array([len(text) for text in prepared_texts], dtype=np.int64) + len(separator)
+        original_lengths = np.array([len(text) for text in original_texts], dtype=np.int64) + len(separator)
+        prepared_starts = np.cumsum(prepared_lengths) - prepared_lengths
+        original_starts = np.cumsum(original_lengths) - original_lengths
+        if separated:
+            classes[prepared_starts] = ord(CHAR_SEPARATOR)
+        keep = (classes == ord(CHAR_KEEP)) | (classes == ord(CHAR_SEPARATOR))
+        if self.normalize_space:
+            # only the first whitespace character after a kept one survives (dropped characters don't interrupt)
+            relevant = np.flatnonzero(classes != ord(CHAR_DROP))
+            if len(relevant) > 0 and self.alphabet.has_label(' '):
+                spaces = classes[relevant] != ord(CHAR_KEEP)
+                keep[relevant[spaces & ~np.concatenate(([False], spaces[:-1]))]] = True
+        kept = np.flatnonzero(keep)
+        clean_offset = len(self.positions)
+        shifts = np.repeat(original_starts - prepared_starts, prepared_lengths)
+        self.positions.frombytes((kept + shifts[kept] + self.original_length).astype(np.uint32).tobytes())
+        kept_starts = np.searchsorted(kept, np.concatenate((prepared_starts, [len(replaced_text)])))
+        for text_index, meta in enumerate(metas):
+            text_start, text_end = kept_starts[text_index:text_index + 2].tolist()
+            if separated:
+                self.add_meta_run(clean_offset + text_start, None)
+                text_start += 1
+            if text_start < text_end:
+                self.add_meta_run(clean_offset + text_start, meta)
+        if len(kept) > 0:
+            codes = np.frombuffer(replaced_text.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+            self.clean_parts.append(codes[kept].tobytes().decode('utf-32-le', 'surrogatepass'))
+        self.original_parts.append(''.join(separator + text for text in original_texts))
+        self.original_length += int(original_lengths.sum())
+
+    def add_original_texts(self, original_texts, metas=None):
+        """
+        Adds texts like calling add_original_text for each of them - but cleans them all at once.
+        :param original_texts: List of texts
+        :param metas: List of meta values (one per text) or None
+        """
+        metas = [None] * len(original_texts) if metas is None else metas
+        index = 0
+        # texts only get separated by a space as soon as there is some clean text
+        while index < len(original_texts) and len(self.positions) == 0:
+            self.clean_texts(original_texts[index:index + 1], metas[index:index + 1], False)
+            index += 1
+        if index < len(original_texts):
+            self.clean_texts(original_texts[index:], metas[index:], True)
 
     def add_original_text(self, original_text, meta=None):
-        if len(self.positions) > 0:
-            self.clean_text += ' '
-            self.original_text += ' '
-            self.positions.append(len(self.original_text) - 1)
-            self.meta.append(None)
-            ws = True
-        else:
-            ws = False
-        cleaned = []
-        prepared_text = original_text.lower() if self.to_lower else original_text
-        for position, c in enumerate(prepared_text):
-            if self.dashes_to_ws and c == '-' and not self.alphabet.has_label('-'):
-                c = ' '
-            if self.normalize_space and c.isspace():
-                if ws:
-                    continue
-                else:
-                    ws = True
-                    c = ' '
-            if not self.alphabet.has_label(c):
-                continue
-            if not c.isspace():
-                ws = False
-            cleaned.append(c)
-            self.positions.append(len(self.original_text) + position)
-            self.meta.append(meta)
-        self.original_text += original_text
-        self.clean_text += ''.join(cleaned)
+        self.add_original_texts([original_text], [meta])
+
+    def save(self, file_path, key, metas=None):
+        """
+        Writes original text, clean text, positions and meta runs into a file from which load can restore them.
+        :param file_path: Path of the file to write
+        :param key: String identifying the original text and the cleaning options
+        :param metas: List of all meta values - the meta runs get stored as indices into it
+        :raises OSError: If the file could not be written
+        """
+        meta_indices = {id(meta): index for index, meta in enumerate(metas or [])}
+        save_arrays(file_path, key, {
+            'original_text': np.frombuffer(self.original_text.encode('utf-8', 'surrogatepass'), dtype=np.uint8),
+            'clean_text': np.frombuffer(self.clean_text.encode('utf-8', 'surrogatepass'), dtype=np.uint8),
+            'positions': np.frombuffer(self.positions, dtype=np.uint32),
+            'meta_starts': np.array(self.meta_starts, dtype=np.int64),
+            'meta_values': np.array([-1 if meta is None else meta_indices[id(meta)] for meta in self.meta_values],
+                                    dtype=np.int64)
+        })
+
+    def load(self, file_path, key, metas=None):
+        """
+        Restores the state that got written by save - replacing all previously added texts.
+        :param file_path: Path of the file to load
+        :param key: Expected key (see save)
+        :param metas: List of all meta values (like passed to save)
+        :return: True if the file got loaded, False if it is missing, broken or has a different key
+        """
+        loaded = load_arrays(file_path, key)
+        if loaded is None:
+            return False
+        arrays, _ = loaded
+        self.original_parts = [arrays['original_text'].tobytes().decode('utf-8', 'surrogatepass')]
+        self.clean_parts = [arrays['clean_text'].tobytes().decode('utf-8', 'surrogatepass')]
+        self.original_length = len(self.original_parts[0])
+        self.positions = array('I')
+        self.positions.frombytes(arrays['positions'].tobytes())
+        self.meta_starts = arrays['meta_starts'].tolist()
+        self.meta_values = [None if index < 0 else metas[index] for index in arrays['meta_values'].tolist()]
+        self.meta_index = None
+        return True
 
     def get_original_offset(self, clean_offset):
         if clean_offset == len(self.positions):
             return self.positions[-1] + 1
         return self.positions[clean_offset]
 
+    def get_meta_run(self, clean_offset):
+        if clean_offset < 0:
+            clean_offset += len(self.positions)
+        if not 0 <= clean_offset < len(self.positions):
+            raise IndexError('Clean offset out of range')
+        return bisect_right(self.meta_starts, clean_offset) - 1
+
+    def get_meta(self, from_clean_offset, to_clean_offset):
+        """
+        Lists the meta of all clean characters within a range of clean offsets (like slicing a per character list).
+        :param from_clean_offset: Start of the range
+        :param to_clean_offset: End of the range (exclusive)
+        :return: List of meta values - one per clean character
+        """
+        from_clean_offset, to_clean_offset, _ = slice(from_clean_offset, to_clean_offset).indices(len(self.positions))
+        metas = []
+        if from_clean_offset >= to_clean_offset:
+            return metas
+        run = self.get_meta_run(from_clean_offset)
+        while run < len(self.meta_starts) and self.meta_starts[run] < to_clean_offset:
+            run_end = self.meta_starts[run + 1] if run + 1 < len(self.meta_starts) else len(self.positions)
+            run_end = min(run_end, to_clean_offset)
+            metas.extend([self.meta_values[run]] * (run_end - max(from_clean_offset, self.meta_starts[run])))
+            run += 1
+        return metas
+
+    def get_meta_index(self):
+        if self.meta_index is None:
+            self.meta_index = IntervalIndex()
+            run_ends = self.meta_starts[1:] + [len(self.positions)]
+            for start, end, meta in zip(self.meta_starts, run_ends, self.meta_values):
+                if meta is not None:
+                    self.meta_index.add(start, end, meta)
+        return self.meta_index
+
     def collect_meta(self, from_clean_offset, to_clean_offset=None):
         if to_clean_offset is None:
-            return self.meta[from_clean_offset]
+            return self.meta_values[self.get_meta_run(from_clean_offset)]
+        from_clean_offset, to_clean_offset, _ = slice(from_clean_offset,
+                                                      to_clean_offset + 1).indices(len(self.positions))
         metas = []
-        for meta in self.meta[from_clean_offset:to_clean_offset + 1]:
-            if meta is not None and meta not in metas:
+        if from_clean_offset >= to_clean_offset:
+            return metas
+        # phrases are only listed once - even if they got added several times
+        listed = set()
+        for meta in self.get_meta_index().overlapping(from_clean_offset, to_clean_offset):
+            if id(meta) not in listed:
+                listed.add(id(meta))
                 metas.append(meta)
         return metas
 
@@ -209,6 +380,97 @@ def similarity(a, b, direction=0, min_ngram_size=1, max_ngram_size=3, size_facto
     return score / sum(ca.values())
 
 
+class WeightedNGramSimilarity(object):
+    """
+    Computes the weighted N-gram similarity of the similarity function for one string and many extensions
+    of another one at once. Weighted N-gram profiles of the first strings are cached.
+    """
+    def __init__(self, direction=0, min_ngram_size=1, max_ngram_size=3, size_factor=1, position_factor=1,
+                 batch_cells=4194304):
+        self.direction = direction
+        self.min_ngram_size = min_ngram_size
+        self.max_ngram_size = max_ngram_size
+        self.size_factor = size_factor
+        self.position_factor = position_factor
+        self.batch_cells = batch_cells
+        self.profiles = {}
+
+    def __call__(self, a, b):
+        return similarity(a, b,
+                          direction=self.direction,
+                          min_ngram_size=self.min_ngram_size,
+                          max_ngram_size=self.max_ngram_size,
+                          size_factor=self.size_factor,
+                          position_factor=self.position_factor)
+
+    def profile(self, s):
+        """
+        Weighted N-gram counts of a string (as computed by the similarity function).
+        :param s: String
+        :return: Tuple (counts, total) - Counter of weighted N-gram counts and their sum
+        """
+        if s not in self.profiles:
+            counts = Counter()
+            for size in range(self.min_ngram_size, self.max_ngram_size + 1):
+                for ng, position_weight in weighted_ngrams(s, size, direction=self.direction):
+                    counts[ng] += size * self.size_factor + position_weight * position_weight * self.position_factor
+            self.profiles[s] = counts, sum(counts.values())
+        return self.profiles[s]
+
+    def extensions(self, a, b, extension):
+        """
+        Computes the similarities of a with b + extension[:i] for all i from 0 to len(extension) - 1.
+        The N-grams of the longest extended string are weighted for blocks of extension lengths at once.
+        :param a: String to compare
+        :param b: String to extend and compare
+        :param extension: Characters to extend b with
+        :return: Array of similarity values - one per extension length
+        """
+        if len(extension) == 0:
+            return np.zeros(0)
+        a_counts, a_total = self.profile(a)
+        s = b + extension[:-1]
+        keys = {ng: key for key, ng in enumerate(a_counts.keys())}
+        # N-grams that are not in a only count towards the totals - they share the last column
+        a_values = np.fromiter(a_counts.values(), dtype=np.float64, count=len(a_counts))
+        # all N-gram occurrences of s - ordered by size and position (like in the profile)
+        sizes, positions, occurrence_keys = [], [], []
+        for size in range(self.min_ngram_size, self.max_ngram_size + 1):
+            for position in range(0, len(s) - size + 1):
+                sizes.append(size)
+                positions.append(position)
+                occurrence_keys.append(keys.get(s[position:position + size], len(a_values)))
+        lengths = len(b) + np.arange(len(extension))
+        sizes, positions = np.array(sizes, dtype=np.int64), np.array(positions, dtype=np.int64)
+        occurrence_keys = np.array(occurrence_keys, dtype=np.int64)
+        direction = -1 if self.direction < 0 else (1 if self.direction > 0 else 0)
+        similarities = np.zeros(len(extension))
+        # extension lengths are processed in blocks of about batch_cells weights and counts
+        block_size = max(1, self.batch_cells // max(1, len(sizes), len(a_values) + 1))
+        for first in range(0, len(extension), block_size):
+            block_lengths = lengths[first:first + block_size]
+            # occurrences that are part of at least one of the extended strings of the block
+            fitting = positions + sizes <= block_lengths[-1]
+            block_sizes, block_positions = sizes[fitting], positions[fitting]
+            # positional weights per (extension length, occurrence) like enweight computes them
+            n = (block_lengths[:, None] - block_sizes[None, :]).astype(np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                c = (block_positions[None, :] + n * (direction - 1) / 2) / n
+            position_weights = np.where(n > 0, c * c * (4 - abs(direction) * 3), 1)
+            values = block_sizes * self.size_factor + position_weights * position_weights * self.position_factor
+            values = np.where(block_positions[None, :] + block_sizes[None, :] <= block_lengths[:, None], values, 0)
+            rows = np.repeat(np.arange(len(block_lengths)), len(block_sizes))
+            b_values = np.bincount(rows * (len(a_values) + 1) + np.tile(occurrence_keys[fitting], len(block_lengths)),
+                                   weights=values.ravel(),
+                                   minlength=len(block_lengths) * (len(a_values) + 1))
+            b_values = b_values.reshape(len(block_lengths), len(a_values) + 1)
+            scores = np.minimum(a_values[None, :], b_values[:, :-1]).sum(axis=1)
+            # normalizing by the N-gram counts of the longer string
+            totals = np.where(block_lengths > len(a), b_values.sum(axis=1), a_total)
+            np.divide(scores, totals, out=similarities[first:first + len(block_lengths)], where=totals > 0)
+        return similarities
+
+
 # The following code is from: http://hetland.org/coding/python/levenshtein.py
 
 # This is a straightforward implementation of a well-known algorithm, and thus
@@ -240,3 +502,62 @@ def levenshtein(a, b):
             current[j] = min(add, delete, change)
 
     return current[n]
+
+
+def bit_levenshtein(a, b, max_distance=None):
+    """
+    Calculates the Levenshtein distance between two sequences of hashable symbols (e.g. strings or lists of
+    integers) by Myers' bit-parallel algorithm (in Hyyrö's formulation) using one Python integer per bit-vector.
+    :param a: Sequence to compare
+    :param b: Sequence to compare
+    :param max_distance: If not None, computation stops as soon as the distance is known to exceed it (Ukkonen cutoff)
+    :return: Levenshtein distance - or max_distance + 1, if it exceeds max_distance
+    """
+    n, m = len(a), len(b)
+    if n > m:
+        # shorter sequence becomes the bit-vector
+        a, b = b, a
+        n, m = m, n
+    if max_distance is not None and m - n > max_distance:
+        return max_distance + 1
+    if n == 0:
+        return m
+    peq = {}
+    for i, symbol in enumerate(a):
+        peq[symbol] = peq.get(symbol, 0) | (1 << i)
+    ones = (1 << n) - 1
+    last = 1 << (n - 1)
+    pv, mv, distance = ones, 0, n
+    for j, symbol in enumerate(b, 1):
+        eq = peq.get(symbol, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & ones)
+        mh = pv & xh
+        if ph & last:
+            distance += 1
+        elif mh & last:
+            distance -= 1
+        # each of the remaining symbols of b can reduce the distance by at most 1
+        if max_distance is not None and distance - (m - j) > max_distance:
+            return max_distance + 1
+        ph = ((ph << 1) | 1) & ones
+        mh = (mh << 1) & ones
+        pv = mh | (~(xv | ph) & ones)
+        mv = ph & xv
+    return distance if max_distance is None or distance <= max_distance else max_distance + 1
+
+
+def word_levenshtein(a, b, max_distance=None):
+    """
+    Calculates the Levenshtein distance between two word sequences by mapping their words to integers
+    and computing the distance of the integer sequences with bit_levenshtein.
+    :param a: List of words
+    :param b: List of words
+    :param max_distance: Same as for bit_levenshtein
+    :return: Same as for bit_levenshtein
+    """
+    words = {}
+    a = [words.setdefault(word, len(words)) for word in a]
+    b = [words.setdefault(word, len(words)) for word in b]
+    return bit_levenshtein(a, b, max_distance=max_distance)
@@ -1,8 +1,12 @@
 
 import os
 import sys
+import json
 import time
 import heapq
+import bisect
+import struct
+import numpy as np
 
 from multiprocessing.dummy import Pool as ThreadPool
 
@@ -13,6 +17,9 @@ GIGABYTE = KILO * MEGABYTE
 TERABYTE = KILO * GIGABYTE
 SIZE_PREFIX_LOOKUP = {'k': KILOBYTE, 'm': MEGABYTE, 'g': GIGABYTE, 't': TERABYTE}
 
+ARRAYS_MAGIC = b'DSALIGN\x01'
+ARRAYS_ALIGNMENT = 64
+
 
 def parse_file_size(file_size):
     file_size = file_size.lower().strip()
@@ -120,7 +127,7 @@ def enweight(items, direction=0):
     if n < 1:
         if n == 0:
             yield items[0], 1
-        raise StopIteration
+        return
     for i, item in enumerate(items):
         c = (i + n * (direction - 1) / 2) / n
         yield item, c * c * (4 - abs(direction) * 3)
@@ -143,6 +150,106 @@ def greedy_minimum_search(a, b, compute, result_a=None, result_b=None):
         return greedy_minimum_search(c, b, compute, result_b=result_b)
 
 
+def best_chain(intervals, weights):
+    """
+    Finds the heaviest chain of intervals that do not overlap and that are in the same order as given
+    (weighted longest increasing subsequence) in O(N log N) using a Fenwick tree of prefix maxima.
+    :param intervals: List of (start, end) tuples
+    :param weights: Weight per interval
+    :return: Indices of the chain's intervals in ascending order
+    """
+    ends = sorted(set(end for _, end in intervals))
+    tree = [(0, -1)] * (len(ends) + 1)
+    predecessors = []
+    for index, ((start, end), weight) in enumerate(zip(intervals, weights)):
+        # heaviest chain whose last interval ends at or before start
+        best, position = (0, -1), bisect.bisect_right(ends, start)
+        while position > 0:
+            best = max(best, tree[position])
+            position -= position & -position
+        predecessors.append(best[1])
+        chain = (best[0] + weight, index)
+        position = bisect.bisect_left(ends, end) + 1
+        while position <= len(ends):
+            tree[position] = max(tree[position], chain)
+            position += position & -position
+    best = max(tree, default=(0, -1))
+    chain, index = [], best[1]
+    while index >= 0:
+        chain.append(index)
+        index = predecessors[index]
+    return chain[::-1]
+
+
+def align_offset(offset, alignment=ARRAYS_ALIGNMENT):
+    return -(-offset // alignment) * alignment
+
+
+def save_arrays(file_path, key, arrays, **meta):
+    """
+    Writes NumPy arrays into a file from which they can later be memory-mapped by load_arrays.
+    The file gets replaced atomically, so that concurrent readers never see partially written files.
+    :param file_path: Path of the file to write
+    :param key: String identifying the content (e.g. a hash of the data the arrays were derived from)
+    :param arrays: Dictionary of named NumPy arrays
+    :param meta: JSON serializable meta data to store along with the arrays
+    :raises OSError: If the file could not be written
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = (array.dtype.str, array.shape, offset)
+        offset = align_offset(offset + array.nbytes)
+    header = json.dumps({'key': key, 'meta': meta, 'arrays': layout}).encode('utf-8')
+    data_start = align_offset(len(ARRAYS_MAGIC) + 8 + len(header))
+    tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as array_file:
+            array_file.write(ARRAYS_MAGIC)
+            array_file.write(struct.pack('<Q', len(header)))
+            array_file.write(header)
+            for name, array in arrays.items():
+                array_file.seek(data_start + layout[name][2])
+                array_file.write(array.tobytes())
+        os.replace(tmp_path, file_path)
+    except OSError:
+        # not leaving partially written files behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_arrays(file_path, key):
+    """
+    Memory-maps (read-only) all arrays of a file that got written by save_arrays.
+    :param file_path: Path of the file to load
+    :param key: Expected content key
+    :return: Tuple (arrays, meta) with a dictionary of the named arrays and the stored meta data
+             or None, if the file is missing, broken or has a different key
+    """
+    if not os.path.isfile(file_path):
+        return None
+    try:
+        with open(file_path, 'rb') as array_file:
+            if array_file.read(len(ARRAYS_MAGIC)) != ARRAYS_MAGIC:
+                return None
+            header_len, = struct.unpack('<Q', array_file.read(8))
+            header = json.loads(array_file.read(header_len).decode('utf-8'))
+        if header['key'] != key:
+            return None
+        data_start = align_offset(len(ARRAYS_MAGIC) + 8 + header_len)
+        arrays = {}
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            if np.prod(shape) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(file_path, dtype=dtype, mode='r', offset=data_start + offset, shape=tuple(shape))
+        return arrays, header['meta']
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+
+
 class Interleaved:
     """Collection that lazily combines sorted collections in an interleaving fashion.
     During iteration the next smallest element from all the sorted collections is always picked.
@@ -159,6 +266,34 @@ class Interleaved:
         return self.len
 
 
+class IntervalIndex:
+    """Index of sorted and non-overlapping half-open intervals with associated values.
+    Listing the values of all intervals that overlap a range takes O(log N + K)."""
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.values = []
+
+    def add(self, start, end, value):
+        if len(self.ends) > 0 and start < self.ends[-1]:
+            raise ValueError('Intervals have to be added in order and must not overlap')
+        if len(self.values) > 0 and self.values[-1] is value and self.ends[-1] == start:
+            self.ends[-1] = end
+        else:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.values.append(value)
+
+    def overlapping(self, start, end):
+        index = bisect.bisect_right(self.ends, start)
+        while index < len(self.starts) and self.starts[index] < end:
+            yield self.values[index]
+            index += 1
+
+    def __len__(self):
+        return len(self.starts)
+
+
 class LimitingPool:
     """Limits unbound ahead-processing of multiprocessing.Pool's imap method
     before items get consumed by the iteration caller.